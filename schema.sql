@@ -21,44 +21,166 @@ CREATE TABLE "community" (
 );
 
 CREATE TABLE "age_range" (
-  "id" serial2 PRIMARY KEY,
+  "id" serial2 PRIMARY KEY CHECK("id" BETWEEN 1 AND 12),
   "name" text NOT NULL UNIQUE
 );
 
 CREATE TABLE "country" (
-  "vkid" int2 PRIMARY KEY, -- unknown: -1
+  "vkid" int2 PRIMARY KEY CHECK("vkid" BETWEEN -1 AND 254), -- unknown: -1
   "name" text NOT NULL UNIQUE
 );
 
 CREATE TABLE "application" (
-  "id" serial2 PRIMARY KEY,
+  "id" serial2 PRIMARY KEY CHECK("id" BETWEEN 1 AND 5),
   "name" text NOT NULL UNIQUE
 );
 
+-- dense id of a profile, must match vkapi/profile.py and vksearch.models.Profile
+-- (3 sexes x 12 age ranges x 256 country slots x 5 applications)
+CREATE FUNCTION profile_id(sex_vkid int4, age_range_id int4, country_vkid int4, app_id int4) RETURNS int4 AS $$
+  SELECT ((sex_vkid * 12 + age_range_id - 1) * 256 + country_vkid + 1) * 5 + app_id - 1;
+$$ LANGUAGE sql IMMUTABLE;
+
 CREATE TABLE "profile" (
-  "id" serial4 PRIMARY KEY,
+  "id" int4 PRIMARY KEY,
   "sex_vkid" int2 NOT NULL CHECK("sex_vkid" IN (0, 1, 2)), -- 0: unknown, 1: female, 2: male (according to VK API)
   "age_range_id" int2 NOT NULL REFERENCES "age_range"("id"),
   "country_vkid" int2 NOT NULL REFERENCES "country"("vkid"),
   "app_id" int2 NOT NULL REFERENCES "application"("id"),
-  UNIQUE ("sex_vkid", "age_range_id", "country_vkid", "app_id")
+  UNIQUE ("sex_vkid", "age_range_id", "country_vkid", "app_id"),
+  CHECK("id" = profile_id("sex_vkid", "age_range_id", "country_vkid", "app_id"))
 );
 
 CREATE TABLE "audience" (
   "community_vkid" int4 NOT NULL REFERENCES "community"("vkid"),
   "profile_id" int4 NOT NULL REFERENCES "profile"("id"),
   "count" int4 NOT NULL CHECK("count" > 0),
+  "margin" int4 CHECK("margin" >= 0), -- of the 95% confidence interval when the count is estimated from a sample
   PRIMARY KEY ("community_vkid", "profile_id")
 );
 
+-- "audience" aggregated for the search (see refresh_audience_cube() and vksearch.models.AudienceCube)
+CREATE TABLE "audience_cube" (
+  "community_vkid" int4 PRIMARY KEY REFERENCES "community"("vkid"),
+  "total" int4 NOT NULL,
+  "perc" int4, -- 100 * "total" / "community.members", vkapi updates it when it rewrites "members"
+  "cells" int4[] NOT NULL, -- by sex, age range and application: [(sex_vkid * 12 + age_range_id - 1) * 5 + app_id]
+  "countries" int4[] NOT NULL -- by country: [country_vkid + 2]
+);
+
+-- the cells of "audience_cube" of every country of the audience
+CREATE TABLE "audience_cube_country" (
+  "community_vkid" int4 NOT NULL REFERENCES "community"("vkid"),
+  "country_vkid" int2 NOT NULL REFERENCES "country"("vkid"),
+  "cells" int4[] NOT NULL,
+  PRIMARY KEY ("community_vkid", "country_vkid")
+);
+
+-- refresh plan of "community" (see vkapi/refresh.py)
+CREATE TABLE "community_refresh" (
+  "community_vkid" int4 PRIMARY KEY REFERENCES "community"("vkid"),
+  "interval" real NOT NULL DEFAULT 86400 CHECK("interval" > 0), -- in seconds
+  "next_update" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  "checks" int4 NOT NULL DEFAULT 0,
+  "changes" int4 NOT NULL DEFAULT 0,
+  "fingerprint" int8, -- of the fields of "community", it's rewritten only when they differ
+  "checked" timestamptz -- "community.updated" is the time of the last change
+);
+
+-- how often users of vksearch have seen a community, decays with time (see vksearch.models.SearchInterest)
+CREATE TABLE "search_interest" (
+  "community_vkid" int4 PRIMARY KEY REFERENCES "community"("vkid"),
+  "hits" real NOT NULL,
+  "updated" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- "search_interest.hits" decayed to now with the half-life of a week,
+-- used by both vkapi/crawlplan.py and vksearch.models.SearchInterest
+CREATE FUNCTION search_interest_hits(hits real, updated timestamptz) RETURNS float8 AS $$
+  SELECT hits * power(0.5, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated)::float8 / (7 * 24 * 3600));
+$$ LANGUAGE sql STABLE;
+
+-- audiences crawled during the last day (see vkapi/crawlplan.py)
+CREATE TABLE "audience_crawl" (
+  "community_vkid" int4 NOT NULL REFERENCES "community"("vkid"),
+  "requests" int4 NOT NULL,
+  "finished" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- partial counts of the audience crawls in progress (see vkapi/tasks/audience.py)
+CREATE TABLE "audience_checkpoint" (
+  "community_vkid" int4 PRIMARY KEY REFERENCES "community"("vkid"),
+  "audience_updated" timestamptz NOT NULL, -- of the community when the crawl started
+  "members" int4 NOT NULL,
+  "seed" int8, -- of the sample, NULL when all the members are crawled
+  "done" int4[] NOT NULL, -- finished tasks
+  "sampled" int4 NOT NULL,
+  "counts" bytea NOT NULL, -- little-endian uint32 (profile id, count) pairs
+  "updated" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- advanced by the transactions of vkapi which change the search results (see vksearch/vksearch/cache.py)
+CREATE TABLE "data_version" (
+  "version" int8 NOT NULL,
+  "updated" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- communities claimed by collector processes (see vkapi/lease.py)
+CREATE TABLE "lease" (
+  "kind" text NOT NULL, -- 'community' or 'audience'
+  "community_vkid" int4 NOT NULL REFERENCES "community"("vkid"),
+  "owner" text NOT NULL,
+  "expires" timestamptz NOT NULL,
+  PRIMARY KEY ("kind", "community_vkid")
+);
+
 CREATE TABLE "account" (
   "token" text PRIMARY KEY,
-  "active" boolean NOT NULL DEFAULT TRUE
+  "active" boolean NOT NULL DEFAULT TRUE,
+  -- request slots shared by all the collectors (see vkapi/tokenpool.py)
+  "rate" real, -- requests per second, NULL: the initial one
+  "next_request" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  "cooldown_until" timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
 
+-- Functions
+-- rebuild the cube of a community from "audience", is called by vkapi when it saves an audience
+CREATE FUNCTION refresh_audience_cube(var_community_vkid int4) RETURNS void AS $$
+BEGIN
+  DELETE FROM "audience_cube" WHERE "community_vkid"=var_community_vkid;
+  DELETE FROM "audience_cube_country" WHERE "community_vkid"=var_community_vkid;
+
+  CREATE TEMP TABLE "audience_cell" ON COMMIT DROP AS
+  SELECT p."country_vkid", (p."sex_vkid" * 12 + p."age_range_id" - 1) * 5 + p."app_id" AS "cell", a."count"
+  FROM "audience" AS a JOIN "profile" AS p ON p."id"=a."profile_id"
+  WHERE a."community_vkid"=var_community_vkid;
+
+  INSERT INTO "audience_cube" ("community_vkid", "total", "perc", "cells", "countries")
+  SELECT var_community_vkid, t."total", 100::int8 * t."total" / NULLIF(c."members", 0),
+    ARRAY(SELECT COALESCE(sum(a."count"), 0)::int4 FROM generate_series(1, 180) AS g("cell")
+          LEFT JOIN "audience_cell" AS a ON a."cell"=g."cell" GROUP BY g."cell" ORDER BY g."cell"),
+    ARRAY(SELECT COALESCE(sum(a."count"), 0)::int4 FROM generate_series(-1, 254) AS g("country_vkid")
+          LEFT JOIN "audience_cell" AS a ON a."country_vkid"=g."country_vkid"
+          GROUP BY g."country_vkid" ORDER BY g."country_vkid")
+  FROM (SELECT sum("count")::int4 AS "total" FROM "audience_cell") AS t, "community" AS c
+  WHERE c."vkid"=var_community_vkid AND t."total" IS NOT NULL;
+
+  INSERT INTO "audience_cube_country" ("community_vkid", "country_vkid", "cells")
+  SELECT var_community_vkid, k."country_vkid", array_agg(COALESCE(a."count", 0) ORDER BY g."cell")
+  FROM (SELECT DISTINCT "country_vkid" FROM "audience_cell") AS k
+  CROSS JOIN generate_series(1, 180) AS g("cell")
+  LEFT JOIN "audience_cell" AS a ON a."country_vkid"=k."country_vkid" AND a."cell"=g."cell"
+  GROUP BY k."country_vkid";
+
+  DROP TABLE "audience_cell";
+END;
+$$ LANGUAGE plpgsql;
+
+
 -- Triggers
--- update "community.updated" when updating
+-- update "community.updated" when updating the fields of the community,
+-- the updates of just "audience_updated" (when the audience is saved) don't change it
 CREATE FUNCTION tgf_community_updated() RETURNS TRIGGER AS $$
 BEGIN
   NEW."updated" := CURRENT_TIMESTAMP;
@@ -66,7 +188,9 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 CREATE TRIGGER tg_community_updated BEFORE UPDATE ON "community"
-FOR EACH ROW EXECUTE PROCEDURE tgf_community_updated();
+FOR EACH ROW WHEN (to_jsonb(OLD) - 'updated' - 'audience_updated' IS DISTINCT FROM
+                   to_jsonb(NEW) - 'updated' - 'audience_updated')
+EXECUTE PROCEDURE tgf_community_updated();
 
 -- update "community.audience_updated" when inserting into "audience"
 CREATE FUNCTION tgf_community_audience_updated() RETURNS TRIGGER AS $$
@@ -81,11 +205,31 @@ CREATE TRIGGER tg_community_audience_updated AFTER INSERT ON "audience"
 REFERENCING NEW TABLE AS new_table
 FOR EACH STATEMENT EXECUTE PROCEDURE tgf_community_audience_updated();
 
+-- plan the refresh of new communities
+CREATE FUNCTION tgf_community_refresh() RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO "community_refresh" ("community_vkid") SELECT "vkid" FROM new_table;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER tg_community_refresh AFTER INSERT ON "community"
+REFERENCING NEW TABLE AS new_table
+FOR EACH STATEMENT EXECUTE PROCEDURE tgf_community_refresh();
+
 -- Indexes
+CREATE INDEX ON "community_refresh" ("next_update");
+CREATE INDEX ON "community" ("audience_updated");
+CREATE INDEX ON "audience_crawl" ("finished");
+-- serve the pages of vksearch ordered by (key, vkid) and sought after a cursor (see vksearch/vksearch/query.py)
+CREATE INDEX ON "community" ("members", "vkid");
+CREATE INDEX ON "audience_cube" ("total", "community_vkid");
+CREATE INDEX ON "audience_cube" ("perc", "community_vkid");
 
 
 -- Initialize tables
 
+INSERT INTO "data_version" ("version") VALUES (1);
+
 INSERT INTO "community_type" ("name")
 VALUES ('PUBLIC_PAGE'),
        ('OPEN_GROUP'),
@@ -351,3 +495,7 @@ VALUES (-1, 'UNKNOWN'),
        (232, 'Южный Судан'),
        (228, 'Ямайка'),
        (229, 'Япония');
+
+INSERT INTO "profile" ("id", "sex_vkid", "age_range_id", "country_vkid", "app_id")
+SELECT profile_id(s."vkid", a."id", c."vkid", p."id"), s."vkid", a."id", c."vkid", p."id"
+FROM generate_series(0, 2) AS s("vkid"), "age_range" AS a, "country" AS c, "application" AS p;
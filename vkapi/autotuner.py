@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from collections import Counter
+from statistics import median
+
+from vkapi.config import MIN_WORKERS
+from vkapi.config import AUTOTUNE_INCREASE
+from vkapi.config import AUTOTUNE_DECREASE
+from vkapi.config import AUTOTUNE_MAX_ERROR_RATE
+from vkapi.config import AUTOTUNE_LATENCY_FACTOR
+from vkapi.config import AUTOTUNE_MAX_DB_LOAD
+
+
+class ConcurrencyController:
+    # Additive increase while all the workers are busy and healthy,
+    # multiplicative decrease on errors, slow responses or a full DB queue
+
+    def __init__(self, loop, limit):
+        self.loop = loop
+        self.limit = limit
+        self.active = 0
+        self.base_latency = None
+        self.latency = None
+        self.error_rate = None
+        self.decisions = Counter()
+        self._latencies = []
+        self._failures = 0
+        self._cond = asyncio.Condition(loop=loop)
+
+    async def acquire(self):
+        async with self._cond:
+            while self.active >= self.limit:
+                await self._cond.wait()
+            self.active += 1
+
+    async def release(self):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def observe(self, latency, failed):
+        self._latencies.append(latency)
+        if failed:
+            self._failures += 1
+
+    async def adjust(self, max_workers, db_load, busy):
+        # busy: no worker was left without a task since the last call
+        latencies, failures = self._latencies, self._failures
+        self._latencies, self._failures = [], 0
+        if not latencies:
+            return
+        self.latency = median(latencies)
+        self.error_rate = failures / len(latencies)
+        if self.base_latency is None or self.latency < self.base_latency:
+            self.base_latency = self.latency
+        else:
+            # forget the best latency slowly, it may never come back
+            self.base_latency *= 1.01
+
+        if self.error_rate > AUTOTUNE_MAX_ERROR_RATE:
+            decision = 'decrease (errors)'
+        elif db_load > AUTOTUNE_MAX_DB_LOAD:
+            decision = 'decrease (db)'
+        elif self.latency > self.base_latency * AUTOTUNE_LATENCY_FACTOR:
+            decision = 'decrease (latency)'
+        elif busy:
+            decision = 'increase'
+        else:
+            decision = 'hold'
+        if decision == 'increase':
+            limit = self.limit + AUTOTUNE_INCREASE
+        elif decision == 'hold':
+            limit = self.limit
+        else:
+            limit = int(self.limit * AUTOTUNE_DECREASE)
+        limit = max(MIN_WORKERS, min(limit, max_workers))
+        self.decisions[decision] += 1
+
+        if limit != self.limit:
+            logging.info('workers: %s -> %s, %s, latency %.2fs (base %.2fs), errors %.0f%%, db queue %.0f%%' % (
+                self.limit, limit, decision, self.latency, self.base_latency, 100 * self.error_rate, 100 * db_load))
+            self.limit = limit
+            async with self._cond:
+                self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'latency': self.latency and round(self.latency, 2),
+            'base_latency': self.base_latency and round(self.base_latency, 2),
+            'error_rate': self.error_rate and round(self.error_rate, 3),
+            'decisions': dict(self.decisions),
+        }
@@ -0,0 +1,116 @@
+"""Compares MembersParser with the former per-user parsing of "groups.getMembers" items.
+
+Usage: python -m vkapi.bench_parser [members] [rounds]
+"""
+import random
+import sys
+import timeit
+from datetime import date as Date
+from datetime import datetime as DateTime
+from datetime import timedelta as TimeDelta
+
+from vkapi.parser import MembersParser
+from vkapi.profile import ProfileCounter, profile_id
+
+
+COUNTRIES = frozenset(range(1, 238))
+UNKNOWN_COUNTRY = -1
+AGE_IDS = tuple(range(1, 13))
+APP_IDS = tuple(range(1, 6))
+
+
+def make_users(num, seed=0):
+    rnd = random.Random(seed)
+    users = []
+    for uid in range(num):
+        user = {'id': uid, 'sex': rnd.choice((0, 1, 2, 2, 1))}
+        kind = rnd.random()
+        if kind < 0.4:
+            user['bdate'] = '%d.%d.%d' % (rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(1940, 2012))
+        elif kind < 0.7:
+            user['bdate'] = '%d.%d' % (rnd.randint(1, 28), rnd.randint(1, 12))
+        if rnd.random() < 0.8:
+            user['country'] = {'id': rnd.choice((1, 1, 1, 2, 3, 4, 65, 300)), 'title': ''}
+        if rnd.random() < 0.9:
+            user['last_seen'] = {'time': 1500000000, 'platform': rnd.randint(1, 7)}
+        users.append(user)
+    return users
+
+
+def _age_id(bdate):
+    if bdate is None:
+        return AGE_IDS[0]
+    parts = bdate.split('.')
+    if len(parts) < 3:
+        return AGE_IDS[0]
+    try:
+        bdate = DateTime(int(parts[2]), int(parts[1]), int(parts[0]))
+    except ValueError:
+        return AGE_IDS[0]
+    now = DateTime.utcnow()
+    if bdate > now:
+        return AGE_IDS[0]
+    age = (now - bdate).days / 365.25
+    for i, limit in enumerate((15, 18, 22, 26, 30, 35, 40, 45, 50, 60)):
+        if age < limit:
+            return AGE_IDS[i + 1]
+    return AGE_IDS[-1]
+
+
+def per_user_count(users, counter):
+    # The per-member path TaskToUpdateAudience used before MembersParser
+    platform2app = {None: 1, 6: 1, 2: 2, 3: 2, 4: 3, 1: 4, 5: 4, 8: 4, 7: 5}
+    for user in users:
+        sex = user.get('sex')
+        if sex not in (0, 1, 2):
+            continue
+        age = _age_id(user.get('bdate'))
+        country = user.get('country')
+        country = UNKNOWN_COUNTRY if country is None or country['id'] not in COUNTRIES else country['id']
+        last_seen = user.get('last_seen')
+        app = 1 if last_seen is None else platform2app[last_seen.get('platform')]
+        counter.add(profile_id(sex, age, country, app))
+
+
+def make_batch_count():
+    # One parser lives as long as the crawl of a community
+    parser = MembersParser(COUNTRIES, UNKNOWN_COUNTRY, AGE_IDS, APP_IDS)
+
+    def batch_count(users, counter):
+        parser.count(parser.parse(users), counter)
+    return batch_count
+
+
+def _birthday(bdate):
+    parts = (bdate or '').split('.')
+    return tuple(parts[:2]) if len(parts) >= 2 else None
+
+
+def check(users):
+    # Both parsings must count the same. The former one counted the age by days / 365.25,
+    # so whoever has a birthday today stayed in the previous age range for one more day,
+    # MembersParser moves them into the new one. The birthdays next to today are left out
+    # (the former parsing used UTC, MembersParser uses the local date).
+    today = Date.today()
+    boundary = {(str(d.day), str(d.month)) for d in (today - TimeDelta(days=1), today, today + TimeDelta(days=1))}
+    users = [user for user in users if _birthday(user.get('bdate')) not in boundary]
+    expected, found = ProfileCounter(), ProfileCounter()
+    per_user_count(users, expected)
+    make_batch_count()(users, found)
+    assert found.items() == expected.items(), 'MembersParser counts differently'
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    users = make_users(members)
+    check(users)
+    for name, fn in (('per-user', per_user_count), ('batch', make_batch_count())):
+        counter = ProfileCounter()
+        seconds = min(timeit.repeat(lambda: fn(users, counter), number=1, repeat=rounds))
+        print('%-8s %8.1f ms per %s members, %6.2f us per member' % (
+            name, seconds * 1000, members, seconds * 1e6 / members))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,59 @@ DATABASE = {
     'password': _SECRETS['db_pass']
 }
 
-WORKERS_PER_TOKEN = 1
-REQUEST_DELAY_PER_TOKEN = 0.5  # in seconds
+WORKERS_PER_TOKEN = 1  # initially, then the number of workers is tuned at runtime
+MIN_WORKERS = 1
+MAX_WORKERS_PER_TOKEN = 4
+AUTOTUNE_INTERVAL = 10  # in seconds
+AUTOTUNE_INCREASE = 1  # workers added when all of them are busy and healthy
+AUTOTUNE_DECREASE = 0.7  # the number of workers is multiplied by it when overloaded
+AUTOTUNE_MAX_ERROR_RATE = 0.1
+AUTOTUNE_LATENCY_FACTOR = 2  # overload when the median latency exceeds the best one so many times
+AUTOTUNE_MAX_DB_LOAD = 0.8  # of DB_WRITE_QUEUE_SIZE
+REQUEST_DELAY_PER_TOKEN = 0.5  # in seconds, the initial one (shared by all the collectors)
+TOKEN_SLOTS_PER_RESERVATION = 5  # request slots of a token reserved by a collector at once
+TOKEN_MAX_RATE = 3  # requests per second (the VK API limit)
+TOKEN_MIN_RATE = 0.2  # requests per second
+TOKEN_RATE_STEP = 0.01  # requests per second added after every success
+TOKEN_COOLDOWNS = {6: 1, 9: 60, 29: 3600}  # in seconds by VK API error code, doubles with every strike
+TOKEN_MAX_COOLDOWN = 6 * 3600  # in seconds
+TOKENS_RELOAD_INTERVAL = 300  # in seconds
 REQUEST_TIMEOUT = 120  # in seconds
+PARSER_EXECUTOR = 'process'  # 'process', 'thread' or None to parse responses in the event loop
+PARSER_WORKERS = None  # None means the number of CPUs
 TRIES_PER_TASK = 2
+RETRY_DELAY = 10  # in seconds, doubles with every try
+SCHEDULER_IDLE_DELAY = 1  # in seconds, when there is nothing to do
+MIN_RELOAD_INTERVAL = 60  # in seconds, between two loads of the work queue of a task class
+LEASE_TTL = 600  # in seconds, claims of a collector that has died expire after it
+LEASE_RENEW_INTERVAL = 120  # in seconds
+COMMUNITIES_CLAIM_SIZE = 7000  # communities claimed by a collector at once
+COMMUNITY_MIN_REFRESH_INTERVAL = 3600  # in seconds
+COMMUNITY_MAX_REFRESH_INTERVAL = 30 * 24 * 3600  # in seconds
+COMMUNITY_REFRESH_SPEEDUP = 0.5  # the refresh interval is multiplied by it when a community has changed
+COMMUNITY_REFRESH_SLOWDOWN = 1.5  # and by it when a community hasn't changed
+COMMUNITY_MEMBERS_CHANGE = 0.01  # of the members, smaller changes are ignored
+COMMUNITIES_REQUESTS_PER_DAY = 20000  # "groups.getById" requests the refresh planner may spend a day
+REFRESH_PLAN_INTERVAL = 3600  # in seconds
+AUDIENCES_CLAIM_SIZE = 20  # communities whose audiences are claimed by a collector at once
+AUDIENCE_MIN_MEMBERS = 50000  # audiences of smaller communities aren't crawled
+AUDIENCE_SAMPLING_MIN_MEMBERS = 1000000  # audiences of bigger communities are estimated from a sample
+AUDIENCE_SAMPLE_REQUESTS = 25  # "execute" requests of a sample (500000 members)
+AUDIENCE_CHECKPOINT_TASKS = 10  # the partial counts of a crawl are saved after so many tasks
+AUDIENCE_REQUESTS_PER_DAY = 100000  # "execute" requests (of 20000 members) the crawls may spend a day
+AUDIENCE_SIZE_BANDS = ((1000000, 2.0), (200000, 1.5))  # (min members, weight of the crawl value), else 1
+AUDIENCE_INTEREST_WEIGHT = 0.1  # the crawl value added by a search hit
+SCHEDULER_FAIRNESS_WINDOW = 100  # last tasks taken into account
+SCHEDULER_MIN_SHARE = 0.5  # of the weighted share guaranteed to a task class
+COMMUNITIES_WEIGHT = 1
+COMMUNITIES_BUDGET = None  # max tasks in flight, None means no limit
+AUDIENCE_WEIGHT = 3
+AUDIENCE_BUDGET = None
+STATS_INTERVAL = 60  # in seconds
+AUDIENCES_IN_FLIGHT = 10  # communities whose audiences are crawled at the same time
 DELAYS_BEFORE_RECONNECT_TO_DB = range(0, 10)  # in seconds
+DB_POOL_SIZE = 4  # connections (and threads) used by the collector
+DB_WRITERS = 2
+DB_WRITE_QUEUE_SIZE = 100  # workers wait when so many writes are pending
+COMMUNITIES_FLUSH_SIZE = 1000  # buffered community updates that trigger a flush
+COMMUNITIES_FLUSH_DELAY = 5  # in seconds, max age of a buffered update
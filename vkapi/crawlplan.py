@@ -0,0 +1,80 @@
+import logging
+
+from vkapi.config import AUDIENCE_MIN_MEMBERS
+from vkapi.config import AUDIENCE_REQUESTS_PER_DAY
+from vkapi.config import AUDIENCE_SIZE_BANDS
+from vkapi.config import AUDIENCE_INTEREST_WEIGHT
+from vkapi.config import AUDIENCE_SAMPLING_MIN_MEMBERS
+from vkapi.config import AUDIENCE_SAMPLE_REQUESTS
+
+
+class CrawlPlanner:
+    # A crawl costs a request per step of members (or the requests of a sample),
+    # its value grows with the staleness of the audience, the size band of the community
+    # and the interest of the users of vksearch. Audiences are crawled in the order
+    # of value per request while the requests of the last day fit into AUDIENCE_REQUESTS_PER_DAY.
+
+    def __init__(self, step):
+        self.step = step
+        self.remaining = None
+
+    def _cost(self, members='c."members"'):
+        # Must match sampled_tasks() in vkapi/tasks/audience.py
+        return ('CASE WHEN {members} >= {threshold:d} THEN LEAST(ceil({members} / {step:f}), {sample:d}) '
+                'ELSE ceil({members} / {step:f}) END').format(members=members, step=self.step,
+                                                              threshold=AUDIENCE_SAMPLING_MIN_MEMBERS,
+                                                              sample=AUDIENCE_SAMPLE_REQUESTS)
+
+    def columns(self):
+        bands = ' '.join('WHEN c."members" >= {0:d} THEN {1:f}'.format(members, weight)
+                         for members, weight in AUDIENCE_SIZE_BANDS)
+        value = ('(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - c."audience_updated")::float8 / 86400) '
+                 '* (CASE {bands} ELSE 1 END) '
+                 '* (1 + {interest:f} * COALESCE(search_interest_hits(i."hits", i."updated"), 0))').format(
+                     bands=bands, interest=AUDIENCE_INTEREST_WEIGHT)
+        cost = self._cost()
+        return ('c."vkid", c."members", c."audience_updated", '
+                '{value} / {cost} AS "priority"').format(value=value, cost=cost)
+
+    def join(self):
+        return 'LEFT JOIN "search_interest" AS i ON i."community_vkid" = c."vkid"'
+
+    def condition(self):
+        # Communities which cost more than the rest of the budget are skipped
+        return ('c."deactivated" = FALSE AND c."members" >= {0:d} '
+                'AND {1} <= {2:d}').format(AUDIENCE_MIN_MEMBERS, self._cost(), self.remaining)
+
+    async def update_budget(self, db):
+        self.remaining = await db.transaction(self._remaining_budget)
+        return self.remaining
+
+    def _remaining_budget(self, db):
+        sql = ('DELETE FROM "audience_crawl" '
+               'WHERE "finished" < CURRENT_TIMESTAMP - INTERVAL \'1 day\'')
+        db.execute(sql)
+        # The crawls in progress are paid for in advance
+        sql = ('SELECT '
+               '(SELECT COALESCE(sum("requests"), 0) FROM "audience_crawl"), '
+               '(SELECT COALESCE(sum({cost}), 0) '
+               'FROM "lease" AS l JOIN "community" AS c ON c."vkid" = l."community_vkid" '
+               'WHERE l."kind" = %s AND l."expires" > CURRENT_TIMESTAMP)').format(cost=self._cost())
+        spent, reserved = db.execute(sql, ('audience',), handler=lambda row: row)[0]
+        return max(AUDIENCE_REQUESTS_PER_DAY - int(spent) - int(reserved), 0)
+
+    def fit(self, audiences):
+        # Splits the claimed audiences into the ones that fit into the budget and the rest
+        planned, cost = [], 0
+        for aud in audiences:
+            if cost + aud.tasks > self.remaining:
+                break
+            cost += aud.tasks
+            planned.append(aud)
+        logging.info('crawl plan: %s audiences for %s requests, %s of %s requests a day are left' % (
+            len(planned), cost, self.remaining - cost, AUDIENCE_REQUESTS_PER_DAY))
+        return planned, audiences[len(planned):]
+
+    @staticmethod
+    def log_crawl(db, vkid, requests):
+        sql = ('INSERT INTO "audience_crawl" ("community_vkid", "requests") '
+               'VALUES (%s, %s)')
+        db.execute(sql, (vkid, requests))
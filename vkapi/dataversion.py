@@ -0,0 +1,7 @@
+def advance_data_version(db):
+    # vksearch drops its cached search results of the previous version.
+    # Must be the last statement of a transaction: the row is locked until the commit,
+    # and the other transactions which advance the version wait only for the commit
+    sql = ('UPDATE "data_version" '
+           'SET "version" = "version" + 1, "updated" = CURRENT_TIMESTAMP')
+    db.execute(sql)
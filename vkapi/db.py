@@ -1,94 +1,178 @@
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
-import time
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 from vkapi.config import DATABASE
+from vkapi.config import DB_POOL_SIZE
+from vkapi.config import DB_WRITERS
+from vkapi.config import DB_WRITE_QUEUE_SIZE
 from vkapi.config import DELAYS_BEFORE_RECONNECT_TO_DB
 
 
-def _use_transaction_mode(fn):
-    def wrapper(self, *args, **kwargs):
-        if self._transaction_mode:
-            return fn(self, *args, **kwargs)
-        else:
-            exc = None
-            for delay in DELAYS_BEFORE_RECONNECT_TO_DB:
-                try:
-                    if self._conn is None:
-                        self._connect()
-                    result = fn(self, *args, **kwargs)
-                    self._conn.commit()
-                    return result
-                except psycopg2.Error as err:
-                    logging.warning(repr(err))
-                    exc = err
-                    self._rollback()
-                    self.close()
-                    time.sleep(delay)
-            raise exc
-    return wrapper
-
+class Transaction:
+    # Is used inside the executor's threads only
 
-class Database:
+    def __init__(self, conn):
+        self._conn = conn
 
-    _conn = None
-
-    @staticmethod
-    def retry(fn):
-        def wrapper(*args, **kwargs):
-            for delay in DELAYS_BEFORE_RECONNECT_TO_DB:
-                try:
-                    return fn(*args, **kwargs)
-                except psycopg2.Error as err:
-                    logging.warning(repr(err))
-                    time.sleep(delay)
-            return fn(*args, **kwargs)
-        return wrapper
-
-    def __init__(self):
-        self._transaction_mode = False
-        if self._conn is None:
-            self._connect()
-
-    def _connect(self):
-        self._conn = psycopg2.connect(host=DATABASE['host'], port=DATABASE['port'],
-                                      dbname=DATABASE['dbname'], user=DATABASE['user'],
-                                      password=DATABASE['password'])
-
-    @_use_transaction_mode
     def execute(self, sql, params=None, handler=None):
         with self._conn.cursor() as cursor:
             cursor.execute(sql, params)
             if handler is not None:
                 return [handler(row) for row in cursor]
 
-    @_use_transaction_mode
     def executemany(self, sql, params_list):
         with self._conn.cursor() as cursor:
             cursor.executemany(sql, params_list)
 
-    @classmethod
-    def close(cls):
-        if cls._conn is not None:
+    def copy_expert(self, sql, file):
+        with self._conn.cursor() as cursor:
+            cursor.copy_expert(sql, file)
+
+    def execute_values(self, sql, params_list, template=None):
+        # Sends all the rows as a single VALUES list
+        with self._conn.cursor() as cursor:
+            execute_values(cursor, sql, params_list, template, page_size=max(len(params_list), 1))
+
+
+class Database:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._pool = ThreadedConnectionPool(0, DB_POOL_SIZE,
+                                            host=DATABASE['host'], port=DATABASE['port'],
+                                            dbname=DATABASE['dbname'], user=DATABASE['user'],
+                                            password=DATABASE['password'])
+        self._executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE)
+        self._queue = asyncio.Queue(DB_WRITE_QUEUE_SIZE, loop=loop)
+        self._writers = []
+
+    def start(self):
+        self._writers = [asyncio.ensure_future(self._writer(), loop=self.loop) for _ in range(DB_WRITERS)]
+
+    async def execute(self, sql, params=None, handler=None):
+        return await self.transaction(lambda db: db.execute(sql, params, handler))
+
+    async def executemany(self, sql, params_list):
+        return await self.transaction(lambda db: db.executemany(sql, params_list))
+
+    async def transaction(self, fn):
+        exc = None
+        for delay in DELAYS_BEFORE_RECONNECT_TO_DB:
             try:
-                cls._conn.close()
-            except Exception:
-                pass
-            cls._conn = None
+                return await self.loop.run_in_executor(self._executor, self._run, fn)
+            except psycopg2.Error as err:
+                logging.warning(repr(err))
+                exc = err
+                await asyncio.sleep(delay, loop=self.loop)
+        raise exc
 
-    def _rollback(self):
+    def _run(self, fn):
+        conn = self._pool.getconn()
         try:
-            self._conn.rollback()
+            result = fn(Transaction(conn))
+            conn.commit()
+            return result
+        except Exception:
+            self._rollback(conn)
+            raise
+        finally:
+            self._pool.putconn(conn, close=bool(conn.closed))
+
+    @staticmethod
+    def _rollback(conn):
+        try:
+            conn.rollback()
         except Exception:
             pass
 
-    def __enter__(self):
-        self._transaction_mode = True
-        return self
+    async def write(self, fn):
+        # Blocks the caller while the queue is full
+        await self._queue.put(fn)
+
+    def pending_writes(self):
+        return self._queue.qsize()
+
+    async def _writer(self):
+        while True:
+            fn = await self._queue.get()
+            try:
+                await self.transaction(fn)
+            except Exception as err:
+                logging.exception(err)
+            finally:
+                self._queue.task_done()
+
+    async def close(self):
+        if self._writers:
+            await self._queue.join()
+        for writer in self._writers:
+            writer.cancel()
+        self._writers = []
+        self._executor.shutdown()
+        self._pool.closeall()
+
+
+class WriteBehindBuffer:
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._transaction_mode = False
-        if exc_type is None:
-            self._conn.commit()
-        else:
-            self._rollback()
+    def __init__(self, db, name, flush_fn, max_size, max_delay):
+        self.db = db
+        self.name = name
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.flushed_rows = 0
+        self.flush_time = 0.0
+        self._flush_fn = flush_fn
+        self._items = {}
+        self._timer = None
+        self._lock = asyncio.Lock(loop=db.loop)
+
+    def __len__(self):
+        return len(self._items)
+
+    async def add(self, key, item):
+        self._items[key] = item
+        if len(self._items) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = self.db.loop.call_later(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self._flush_in_background(), loop=self.db.loop)
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except Exception as err:
+            logging.exception(err)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._items:
+                return
+            pending = self._items
+            items = list(pending.values())
+            self._items = {}
+            started = self.db.loop.time()
+            try:
+                await self.db.transaction(lambda db: self._flush_fn(db, items))
+            except Exception:
+                # Retried with the next flush, the items added meanwhile are newer
+                for key, item in pending.items():
+                    self._items.setdefault(key, item)
+                if self._timer is None:
+                    self._timer = self.db.loop.call_later(self.max_delay, self._on_timer)
+                raise
+            elapsed = self.db.loop.time() - started
+        self.flushed_rows += len(items)
+        self.flush_time += elapsed
+        logging.info('%s: %s rows were flushed in %.3fs (%.0f rows/s)' % (
+            self.name, len(items), elapsed, len(items) / max(elapsed, 1e-6)))
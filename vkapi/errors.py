@@ -3,8 +3,33 @@ class Error(Exception):
 
 
 class VKAPIResponseError(Error):
-    pass
+
+    def __init__(self, msg, code=None):
+        super().__init__(msg)
+        self.code = code
+
+
+class VKAPIThrottlingError(VKAPIResponseError):
+    # 6: too many requests per second, 9: flood control, 29: rate limit reached
+    CODES = (6, 9, 29)
+
+
+class VKAPIAuthError(VKAPIResponseError):
+    # 5: user authorization failed (the token is revoked or expired)
+    CODES = (5,)
 
 
 class VKAPIParsingError(Error):
     pass
+
+
+def response_error(err):
+    errmsg = 'Unknown VKAPI error'
+    code = None
+    if err:
+        errmsg = err.get('error_msg', errmsg)
+        code = err.get('error_code')
+    for cls in (VKAPIThrottlingError, VKAPIAuthError):
+        if code in cls.CODES:
+            return cls(errmsg, code)
+    return VKAPIResponseError(errmsg, code)
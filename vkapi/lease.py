@@ -0,0 +1,92 @@
+import logging
+import os
+import socket
+import uuid
+
+from vkapi.config import LEASE_TTL
+from vkapi.config import LEASE_RENEW_INTERVAL
+
+
+OWNER = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class Leases:
+    # Collector processes share the communities through the "lease" table:
+    # a process claims a batch of them, renews its claims while working on them
+    # and releases them when the results are saved. Claims of a dead process expire.
+
+    def __init__(self, loop, kind):
+        self.loop = loop
+        self.kind = kind
+        self.claimed = set()
+        self._next_renewal = None
+
+    def __len__(self):
+        return len(self.claimed)
+
+    async def claim(self, db, columns, condition, order_by, limit, handler, join=''):
+        # The first of the columns must be "vkid", order_by may refer to the columns only
+        # SKIP LOCKED keeps concurrent claims from waiting for each other,
+        # the conflict clause keeps them from taking a lease that is still alive
+        sql = ('WITH "free" AS ('
+               'SELECT {columns} '
+               'FROM "community" AS c {join} '
+               'WHERE {condition} '
+               'AND NOT EXISTS ('
+               'SELECT 1 FROM "lease" AS l '
+               'WHERE l."kind" = %(kind)s AND l."community_vkid" = c."vkid" '
+               'AND l."expires" > CURRENT_TIMESTAMP) '
+               'ORDER BY {order_by} '
+               'LIMIT %(limit)s '
+               'FOR UPDATE OF c SKIP LOCKED'
+               '), "claimed" AS ('
+               'INSERT INTO "lease" ("kind", "community_vkid", "owner", "expires") '
+               'SELECT %(kind)s, "vkid", %(owner)s, CURRENT_TIMESTAMP + %(ttl)s * INTERVAL \'1 second\' '
+               'FROM "free" '
+               'ON CONFLICT ("kind", "community_vkid") DO UPDATE '
+               'SET "owner" = EXCLUDED."owner", "expires" = EXCLUDED."expires" '
+               'WHERE "lease"."expires" <= CURRENT_TIMESTAMP '
+               'RETURNING "community_vkid"'
+               ') '
+               'SELECT f.* '
+               'FROM "free" AS f '
+               'JOIN "claimed" ON "claimed"."community_vkid" = f."vkid" '
+               'ORDER BY {order_by}').format(columns=columns, join=join, condition=condition,
+                                                 order_by=order_by)
+        params = {'kind': self.kind, 'owner': OWNER, 'ttl': LEASE_TTL, 'limit': limit}
+        rows = await db.execute(sql, params, handler=lambda row: row)
+        self.claimed.update(row[0] for row in rows)
+        if not self._next_renewal:
+            self._next_renewal = self.loop.time() + LEASE_RENEW_INTERVAL
+        return [handler(row) for row in rows]
+
+    async def renew(self, db):
+        if not self.claimed or self.loop.time() < self._next_renewal:
+            return
+        self._next_renewal = self.loop.time() + LEASE_RENEW_INTERVAL
+        vkids = list(self.claimed)
+        sql = ('UPDATE "lease" '
+               'SET "expires" = CURRENT_TIMESTAMP + %s * INTERVAL \'1 second\' '
+               'WHERE "kind" = %s AND "owner" = %s AND "community_vkid" = ANY(%s) '
+               'RETURNING "community_vkid"')
+        renewed = await db.execute(sql, (LEASE_TTL, self.kind, OWNER, vkids), handler=lambda row: row[0])
+        lost = self.claimed.difference(renewed).intersection(vkids)
+        if lost:
+            # They have expired and may be handled by another process as well
+            logging.warning('%s: %s leases were lost' % (self.kind, len(lost)))
+            self.claimed.difference_update(lost)
+
+    def forget(self, vkids):
+        # The lease is left to expire, the community will be claimed again later
+        self.claimed.difference_update(vkids)
+
+    def release(self, db, vkids):
+        # Is called inside the transaction which saves the results
+        sql = ('DELETE FROM "lease" '
+               'WHERE "kind" = %s AND "owner" = %s AND "community_vkid" = ANY(%s)')
+        db.execute(sql, (self.kind, OWNER, list(vkids)))
+
+    async def release_all(self, db):
+        vkids, self.claimed = list(self.claimed), set()
+        if vkids:
+            await db.transaction(lambda tx: self.release(tx, vkids))
@@ -11,11 +11,13 @@ class App:
 
     def start(self):
         loop = asyncio.get_event_loop()
+        db = Database(loop)
+        client = VKAPIClient(loop, [TaskToUpdateCommunities, TaskToUpdateAudience], db)
         try:
-            client = VKAPIClient(loop, [TaskToUpdateCommunities, TaskToUpdateAudience])
             loop.run_until_complete(client.run())
         finally:
-            Database.close()
+            loop.run_until_complete(client.close())
+            loop.run_until_complete(db.close())
             loop.close()
 
 
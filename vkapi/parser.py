@@ -0,0 +1,184 @@
+import logging
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date as Date
+
+from vkapi import errors
+from vkapi.profile import AGE_RANGES_NUM, APPS_NUM, COUNTRY_SLOTS, ProfileCounter
+from vkapi.config import PARSER_EXECUTOR
+from vkapi.config import PARSER_WORKERS
+
+
+AGE_LIMITS = (15, 18, 22, 26, 30, 35, 40, 45, 50, 60)
+
+_MONTH_DAYS = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _years_ago(today, years):
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        # 29 February
+        return today.replace(year=today.year - years, day=28)
+
+
+class MembersParser:
+    # Turns "groups.getMembers" items into columns and counts them by profile
+
+    def __init__(self, countries_ids, unknown_country, age_ids, app_ids, today=None):
+        # age_ids: UNKNOWN, -14, 15-17, ..., 60+
+        # app_ids: UNKNOWN, IOS, ANDROID, MOBILE, BROWSER
+        if today is None:
+            today = Date.today()
+        self.today = today.year * 10000 + today.month * 100 + today.day
+        self.key = (self.today, frozenset(countries_ids), unknown_country, tuple(age_ids), tuple(app_ids))
+        self.cutoffs = [self._date2int(_years_ago(today, years)) for years in reversed(AGE_LIMITS)]
+        self.age_unknown = age_ids[0]
+        self.age_ids = tuple(reversed(age_ids[1:]))
+        self.unknown_country = unknown_country
+        self.country_slots = bytearray(COUNTRY_SLOTS)
+        for vkid in countries_ids:
+            self.country_slots[vkid + 1] = 1
+        app_unknown, app_ios, app_android, app_mobile, app_browser = app_ids
+        # indexed by "last_seen.platform"
+        self.platform2app = (app_unknown, app_mobile, app_ios, app_ios, app_android,
+                             app_mobile, app_unknown, app_browser, app_mobile)
+        # the same dates come up again and again
+        self._bdates = {None: 0}
+        self._ages = {}
+
+    def __getstate__(self):
+        # Is sent to the parsing processes without the caches
+        state = self.__dict__.copy()
+        state['_bdates'] = {None: 0}
+        state['_ages'] = {}
+        return state
+
+    @staticmethod
+    def _date2int(date):
+        return date.year * 10000 + date.month * 100 + date.day
+
+    def parse(self, users):
+        sexes = array('b')
+        bdates = array('l')
+        countries = array('h')
+        apps = array('b')
+        country_slots = self.country_slots
+        unknown_country = self.unknown_country
+        platform2app = self.platform2app
+        app_unknown = platform2app[0]
+        bdate_cache = self._bdates
+        parse_bdate = self._parse_bdate
+        for user in users:
+            sex = user.get('sex')
+            if sex not in (0, 1, 2):
+                logging.error(errors.VKAPIParsingError('unexpected value of "sex": %s' % sex))
+                continue
+
+            country = user.get('country')
+            if country is None:
+                country = unknown_country
+            else:
+                country = country['id']
+                if not (0 < country < COUNTRY_SLOTS - 1 and country_slots[country + 1]):
+                    country = unknown_country
+
+            last_seen = user.get('last_seen')
+            if last_seen is None:
+                app = app_unknown
+            else:
+                platform = last_seen.get('platform')
+                if platform is None:
+                    app = app_unknown
+                elif type(platform) is int and 0 < platform < len(platform2app):
+                    app = platform2app[platform]
+                else:
+                    logging.error(errors.VKAPIParsingError('unknown platform_id: %s' % platform))
+                    continue
+
+            bdate = user.get('bdate')
+            parsed = bdate_cache.get(bdate)
+            if parsed is None:
+                parsed = bdate_cache[bdate] = parse_bdate(bdate)
+
+            sexes.append(sex)
+            bdates.append(parsed)
+            countries.append(country)
+            apps.append(app)
+        return sexes, bdates, countries, apps
+
+    @staticmethod
+    def _parse_bdate(bdate):
+        # 0 if unknown
+        parts = bdate.split('.')
+        if len(parts) < 3:
+            return 0
+        try:
+            day, month, year = int(parts[0]), int(parts[1]), int(parts[2])
+        except ValueError:
+            return 0
+        if year < 1 or not 0 < month < 13 or not 0 < day <= _MONTH_DAYS[month]:
+            return 0
+        if month == 2 and day == 29 and (year % 4 != 0 or (year % 100 == 0 and year % 400 != 0)):
+            return 0
+        return year * 10000 + month * 100 + day
+
+    def _age_id(self, bdate):
+        if bdate == 0 or bdate > self.today:
+            return self.age_unknown
+        return self.age_ids[bisect_left(self.cutoffs, bdate)]
+
+    def count(self, columns, counter):
+        sexes, bdates, countries, apps = columns
+        counts = counter.counts
+        age_cache = self._ages
+        for sex, bdate, country, app in zip(sexes, bdates, countries, apps):
+            age = age_cache.get(bdate)
+            if age is None:
+                age = age_cache[bdate] = self._age_id(bdate)
+            counts[((sex * AGE_RANGES_NUM + age - 1) * COUNTRY_SLOTS + country + 1) * APPS_NUM + app - 1] += 1
+
+
+_parsers = {}
+
+
+def count_members(parser, parts):
+    # Is run by ParsingExecutor as the reducer of "groups.getMembers" results,
+    # returns (profile_id, count) pairs
+    parser = _parsers.setdefault(parser.key, parser)
+    counter = ProfileCounter()
+    for part in parts:
+        parser.count(parser.parse(part['items']), counter)
+    return counter.items()
+
+
+class ParsingExecutor:
+
+    def __init__(self, loop, kind=PARSER_EXECUTOR, workers=PARSER_WORKERS):
+        self.loop = loop
+        self.kind = kind
+        self.workers = workers
+        self._executor = self._make_executor()
+
+    def _make_executor(self):
+        if self.kind == 'process':
+            return ProcessPoolExecutor(self.workers)
+        if self.kind == 'thread':
+            return ThreadPoolExecutor(self.workers)
+        return None
+
+    async def run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        try:
+            return await self.loop.run_in_executor(self._executor, fn, *args)
+        except BrokenProcessPool:
+            logging.warning('the parsing process pool is broken, restarting it')
+            self._executor = self._make_executor()
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
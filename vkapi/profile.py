@@ -0,0 +1,70 @@
+# A profile's id is computed from its dimensions, so the "profile" table
+# is filled once by schema.sql and never has to be looked up.
+# Must match the profile_id() function in schema.sql.
+
+import sys
+from array import array
+
+
+SEXES_NUM = 3  # sex_vkid: 0..2
+AGE_RANGES_NUM = 12  # age_range_id: 1..12
+COUNTRY_SLOTS = 256  # country_vkid: -1..254
+APPS_NUM = 5  # app_id: 1..5
+
+PROFILES_NUM = SEXES_NUM * AGE_RANGES_NUM * COUNTRY_SLOTS * APPS_NUM
+
+
+def profile_id(sex_vkid, age_range_id, country_vkid, app_id):
+    return ((sex_vkid * AGE_RANGES_NUM + age_range_id - 1) * COUNTRY_SLOTS + country_vkid + 1) * APPS_NUM + app_id - 1
+
+
+def split_profile_id(pid):
+    pid, app_slot = divmod(pid, APPS_NUM)
+    pid, country_slot = divmod(pid, COUNTRY_SLOTS)
+    sex_vkid, age_slot = divmod(pid, AGE_RANGES_NUM)
+    return sex_vkid, age_slot + 1, country_slot - 1, app_slot + 1
+
+
+class ProfileCounter:
+    # One uint32 slot per profile id instead of a dict of boxed ints
+
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = array('I', bytes(PROFILES_NUM * array('I').itemsize))
+
+    def __bool__(self):
+        return any(self.counts)
+
+    def total(self):
+        return sum(self.counts)
+
+    def add(self, pid, num=1):
+        self.counts[pid] += num
+
+    def merge(self, other):
+        counts = self.counts
+        if isinstance(other, ProfileCounter):
+            other = other.items()
+        for pid, num in other:
+            counts[pid] += num
+
+    def items(self):
+        return [(pid, num) for pid, num in enumerate(self.counts) if num]
+
+    def to_bytes(self):
+        # Sparse little-endian uint32 (profile id, count) pairs
+        pairs = array('I', (value for item in self.items() for value in item))
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        return pairs.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        pairs = array('I')
+        pairs.frombytes(data)
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        counter = cls()
+        counter.merge(zip(pairs[::2], pairs[1::2]))
+        return counter
@@ -0,0 +1,103 @@
+import logging
+from datetime import timedelta as TimeDelta
+
+from vkapi.config import COMMUNITY_MIN_REFRESH_INTERVAL
+from vkapi.config import COMMUNITY_MAX_REFRESH_INTERVAL
+from vkapi.config import COMMUNITY_REFRESH_SPEEDUP
+from vkapi.config import COMMUNITY_REFRESH_SLOWDOWN
+from vkapi.config import COMMUNITY_MEMBERS_CHANGE
+from vkapi.config import COMMUNITIES_REQUESTS_PER_DAY
+
+
+DAY = 24 * 3600
+
+
+def community_state(deactivated, name, status):
+    # The fields whose changes are tracked besides the members, hashed to keep the claimed communities compact
+    return hash((deactivated, name, status))
+
+
+class RefreshPlanner:
+    # Every community has its own refresh interval in "community_refresh":
+    # it's shortened when the community has changed since the last refresh
+    # and grows while it stays the same. When the intervals need more requests
+    # than the daily budget, all of them are stretched alike.
+
+    def __init__(self, communities_per_request):
+        self.communities_per_request = communities_per_request
+        self.stretch = 1.0
+        self.changed = 0
+        self.unchanged = 0
+
+    def observe(self, comm):
+        # comm.previous: (state, members) before the refresh
+        first = comm.previous[1] is None
+        if first:
+            comm.changed = False
+        else:
+            comm.changed = self._has_changed(comm.previous, comm)
+            if comm.changed:
+                self.changed += 1
+            else:
+                self.unchanged += 1
+        if comm.deactivated:
+            interval = COMMUNITY_MAX_REFRESH_INTERVAL
+        elif comm.changed:
+            interval = comm.refresh_interval * COMMUNITY_REFRESH_SPEEDUP
+        elif first:
+            interval = comm.refresh_interval
+        else:
+            interval = comm.refresh_interval * COMMUNITY_REFRESH_SLOWDOWN
+        comm.refresh_interval = max(COMMUNITY_MIN_REFRESH_INTERVAL, min(interval, COMMUNITY_MAX_REFRESH_INTERVAL))
+
+    @staticmethod
+    def _has_changed(previous, comm):
+        state, members = previous
+        if state != community_state(comm.deactivated, comm.name, comm.status):
+            return True
+        if comm.members is None:
+            return members != comm.members
+        return abs(comm.members - members) > COMMUNITY_MEMBERS_CHANGE * max(members, 1)
+
+    def save_many(self, db, communities):
+        sql = ('UPDATE "community_refresh" AS r '
+               'SET "interval" = v."interval", '
+               '"next_update" = CURRENT_TIMESTAMP + v."delay" * INTERVAL \'1 second\', '
+               '"checks" = r."checks" + 1, '
+               '"changes" = r."changes" + v."changed"::int4, '
+               '"fingerprint" = v."fingerprint", '
+               '"checked" = CURRENT_TIMESTAMP '
+               'FROM (VALUES %s) AS v ("community_vkid", "interval", "delay", "changed", "fingerprint") '
+               'WHERE r."community_vkid" = v."community_vkid"')
+        template = '(%s::int4, %s::real, %s::real, %s::boolean, %s::int8)'
+        params_list = [(comm.vkid, comm.refresh_interval, comm.refresh_interval * self.stretch, comm.changed,
+                        comm.fingerprint)
+                       for comm in communities]
+        db.execute_values(sql, params_list, template)
+
+    async def plan(self, db):
+        sql = ('SELECT count(*), '
+               'coalesce(sum({day} / "interval"), 0), '
+               'coalesce(avg("interval"), 0), '
+               'count(*) FILTER (WHERE "next_update" < CURRENT_TIMESTAMP), '
+               'coalesce(avg(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - "next_update")::float8) '
+               'FILTER (WHERE "next_update" < CURRENT_TIMESTAMP), 0) '
+               'FROM "community_refresh"').format(day=DAY)
+        rows = await db.execute(sql, handler=lambda row: row)
+        total, refreshes, avg_interval, overdue, avg_lag = rows[0]
+        budget = COMMUNITIES_REQUESTS_PER_DAY * self.communities_per_request
+        coverage = min(1.0, budget / refreshes) if refreshes else 1.0
+        self.stretch = 1 / coverage if coverage else 1.0
+        # A community is refreshed every interval on average, so it's half an interval old
+        staleness = avg_interval * self.stretch / 2 + avg_lag * overdue / max(total, 1)
+        logging.info('refresh plan: %s communities need %.0f refreshes/day, the budget covers %.0f%%, '
+                     '%s are overdue by %s on average, expected staleness %s, changed %s of %s refreshed' % (
+                         total, refreshes, 100 * coverage, overdue, TimeDelta(seconds=int(avg_lag)),
+                         TimeDelta(seconds=int(staleness)), self.changed, self.changed + self.unchanged))
+        return {
+            'communities': total,
+            'refreshes_per_day': refreshes,
+            'coverage': coverage,
+            'overdue': overdue,
+            'staleness': staleness,
+        }
@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import itertools
+from collections import Counter, deque
+from datetime import datetime as DateTime, timedelta as TimeDelta, timezone
+
+from vkapi.config import TRIES_PER_TASK
+from vkapi.config import RETRY_DELAY
+from vkapi.config import SCHEDULER_IDLE_DELAY
+from vkapi.config import SCHEDULER_FAIRNESS_WINDOW
+from vkapi.config import SCHEDULER_MIN_SHARE
+
+
+class Scheduler:
+    # Earliest deadline first, but a class never gets less than
+    # SCHEDULER_MIN_SHARE of its weighted share of the recent tasks
+    # and never has more than its BUDGET of tasks in flight
+
+    def __init__(self, loop, task_classes):
+        self.loop = loop
+        self.task_classes = task_classes
+        self._seq = itertools.count()
+        self._delayed = []  # (not before, seq, task)
+        self._ready = []  # (deadline, seq, task)
+        self._history = deque(maxlen=SCHEDULER_FAIRNESS_WINDOW)
+        self._lock = asyncio.Lock(loop=loop)
+        self.in_flight = Counter()
+        self.handed_out = Counter()
+        self.lateness = Counter()  # seconds, exponentially weighted
+        self.max_lateness = Counter()
+        self.idle_waits = 0
+
+    async def next_task(self, db):
+        while True:
+            async with self._lock:
+                for cls in self.task_classes:
+                    await cls.prepare(db)
+                task = self._pick(DateTime.now(timezone.utc))
+            if task is not None:
+                return task
+            self.idle_waits += 1
+            await asyncio.sleep(SCHEDULER_IDLE_DELAY, loop=self.loop)
+
+    def poll(self, max_calls):
+        # Doesn't wait, returns a task with no more than max_calls API calls or None
+        return self._pick(DateTime.now(timezone.utc), max_calls)
+
+    def _pick(self, now, max_calls=None):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, task = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (task.due, seq, task))
+
+        candidates = {}
+        if self._ready and (max_calls is None or type(self._ready[0][2]).CALLS <= max_calls):
+            due, _, task = self._ready[0]
+            candidates[type(task)] = due
+        for cls in self.task_classes:
+            if cls in candidates or not cls.has_work():
+                continue
+            if max_calls is not None and cls.CALLS > max_calls:
+                continue
+            if cls.BUDGET is not None and self.in_flight[cls] >= cls.BUDGET:
+                continue
+            candidates[cls] = cls.deadline()
+        if not candidates:
+            return None
+
+        cls = self._starving(candidates) or min(candidates, key=candidates.get)
+        if self._ready and type(self._ready[0][2]) is cls:
+            task = heapq.heappop(self._ready)[2]
+        else:
+            task = cls()
+            task.due = candidates[cls]
+        self._hand_out(task, now)
+        return task
+
+    def _starving(self, candidates):
+        if len(self._history) < self._history.maxlen:
+            return None
+        counts = Counter(self._history)
+        total_weight = sum(cls.WEIGHT for cls in candidates)
+        worst, worst_ratio = None, SCHEDULER_MIN_SHARE
+        for cls in candidates:
+            expected = len(self._history) * cls.WEIGHT / total_weight
+            ratio = counts[cls] / expected
+            if ratio < worst_ratio:
+                worst, worst_ratio = cls, ratio
+        return worst
+
+    def _hand_out(self, task, now):
+        cls = type(task)
+        self._history.append(cls)
+        self.in_flight[cls] += 1
+        self.handed_out[cls] += 1
+        lateness = max((now - task.due).total_seconds(), 0.0)
+        self.lateness[cls] = 0.9 * self.lateness[cls] + 0.1 * lateness
+        self.max_lateness[cls] = max(self.max_lateness[cls], lateness)
+
+    def done(self, task):
+        self.in_flight[type(task)] -= 1
+
+    async def retry(self, task, db, penalize=True):
+        # A task isn't penalized when the token, not the task, has failed
+        if penalize:
+            task.tries += 1
+        if task.tries < TRIES_PER_TASK:
+            delay = TimeDelta(seconds=RETRY_DELAY * 2 ** max(task.tries - 1, 0))
+            heapq.heappush(self._delayed, (DateTime.now(timezone.utc) + delay, next(self._seq), task))
+        else:
+            await task.cancel(db)
+
+    def depth(self):
+        return len(self._delayed) + len(self._ready) + sum(cls.pending() for cls in self.task_classes)
+
+    def stats(self):
+        retries = Counter(type(task) for _, _, task in self._delayed + self._ready)
+        return {
+            cls.__name__: {
+                'pending': cls.pending(),
+                'retries': retries[cls],
+                'in_flight': self.in_flight[cls],
+                'handed_out': self.handed_out[cls],
+                'lateness': round(self.lateness[cls], 1),
+                'max_lateness': round(self.max_lateness[cls], 1),
+            }
+            for cls in self.task_classes
+        }
@@ -1,23 +1,44 @@
-import asyncio
+import io
 import logging
 import math
-from collections import namedtuple
+import random
 from datetime import datetime as DateTime, timedelta as TimeDelta, timezone
 from queue import deque
 
 from vkapi import errors
-from vkapi.db import Database
+from vkapi.crawlplan import CrawlPlanner
+from vkapi.dataversion import advance_data_version
+from vkapi.lease import Leases
+from vkapi.parser import MembersParser, count_members
+from vkapi.profile import ProfileCounter
 from vkapi.tasks.basetask import BaseTask
+from vkapi.tasks.execute import Call
+from vkapi.config import AUDIENCES_IN_FLIGHT
+from vkapi.config import AUDIENCE_WEIGHT
+from vkapi.config import AUDIENCE_BUDGET
+from vkapi.config import MIN_RELOAD_INTERVAL
+from vkapi.config import AUDIENCES_CLAIM_SIZE
+from vkapi.config import AUDIENCE_SAMPLING_MIN_MEMBERS
+from vkapi.config import AUDIENCE_SAMPLE_REQUESTS
+from vkapi.config import AUDIENCE_CHECKPOINT_TASKS
 
 
 STEP = 20000
+PAGE = 1000  # members returned by a "groups.getMembers" call
 
 
-Profile = namedtuple('Profile', ['sex_vkid', 'age_range_id', 'country_vkid', 'app_id'])
+def sampled_tasks(members, step):
+    # Audiences of the biggest communities are estimated from a sample
+    if members >= AUDIENCE_SAMPLING_MIN_MEMBERS:
+        return min(math.ceil(members / step), AUDIENCE_SAMPLE_REQUESTS)
+    return math.ceil(members / step)
 
 
 class AudienceOfCommunity:
 
+    __slots__ = ('vkid', 'members', 'updated', 'counter', 'parser', 'sample', 'seed', 'sampled',
+                 'tasks', 'todo', 'done', 'unfinished_tasks', 'since_checkpoint', '_restored_counts')
+
     UNKNOWN_COUNTRY = None
     countries_ids = None
 
@@ -40,22 +61,20 @@ class AudienceOfCommunity:
     APP_MOBILE = None
     APP_BROWSER = None
 
-    _profile2id = None
-
     @classmethod
-    def _init_countries_ids(cls):
+    async def init_countries_ids(cls, db):
         sql = ('SELECT "vkid", "name" '
                'FROM "country"')
-        kvpairs = Database().execute(sql, handler=lambda row: (row[1], row[0]))
+        kvpairs = await db.execute(sql, handler=lambda row: (row[1], row[0]))
         name2id = dict(kvpairs)
         cls.UNKNOWN_COUNTRY = name2id.pop('UNKNOWN')
         cls.countries_ids = frozenset(name2id.values())
 
     @classmethod
-    def _init_age_ranges(cls):
+    async def init_age_ranges(cls, db):
         sql = ('SELECT "id", "name" '
                'FROM "age_range"')
-        kvpairs = Database().execute(sql, handler=lambda row: (row[1], row[0]))
+        kvpairs = await db.execute(sql, handler=lambda row: (row[1], row[0]))
         name2id = dict(kvpairs)
         cls.AGE_UNKNOWN = name2id['UNKNOWN']
         cls.AGE_14_AND_YOUNGER = name2id['-14']
@@ -71,10 +90,10 @@ class AudienceOfCommunity:
         cls.AGE_60_AND_OLDER = name2id['60+']
 
     @classmethod
-    def _init_applications(cls):
+    async def init_applications(cls, db):
         sql = ('SELECT "id", "name" '
                'FROM "application"')
-        kvpairs = Database().execute(sql, handler=lambda row: (row[1], row[0]))
+        kvpairs = await db.execute(sql, handler=lambda row: (row[1], row[0]))
         name2id = dict(kvpairs)
         cls.APP_UNKNOWN = name2id['UNKNOWN']
         cls.APP_IOS = name2id['IOS']
@@ -83,224 +102,334 @@ class AudienceOfCommunity:
         cls.APP_BROWSER = name2id['BROWSER']
 
     @classmethod
-    def _load_profiles(cls):
-        sql = ('SELECT "id", "sex_vkid", "age_range_id", "country_vkid", "app_id" '
-               'FROM "profile"')
-        kvpairs = Database().execute(sql, handler=lambda row: (Profile(row[1], row[2], row[3], row[4]), row[0]))
-        cls._profile2id = dict(kvpairs)
+    async def claim_by_priority(cls, db, leases, planner, limit):
+        return await leases.claim(db, planner.columns(), planner.condition(), '"priority" DESC', limit,
+                                  handler=lambda row: cls(row[0], row[1], row[2]), join=planner.join())
 
     @classmethod
-    def load_ordered_by_update_time(cls, min_members):
-        sql = ('SELECT "vkid", "members" '
-               'FROM "community" '
-               'WHERE "deactivated" = FALSE '
-               'AND "members" >= {0:d} '
-               'ORDER BY "audience_updated" ASC').format(min_members)
-        return Database().execute(sql, handler=lambda row: cls(row[0], row[1]))
-
-    def __init__(self, comm_vkid, members):
-        if self.UNKNOWN_COUNTRY is None:
-            self._init_countries_ids()
-            self._init_applications()
-            self._init_age_ranges()
-            self._load_profiles()
+    def make_parser(cls):
+        age_ids = (cls.AGE_UNKNOWN, cls.AGE_14_AND_YOUNGER, cls.AGE_15_17, cls.AGE_18_21, cls.AGE_22_25,
+                   cls.AGE_26_29, cls.AGE_30_34, cls.AGE_35_39, cls.AGE_40_44, cls.AGE_45_49,
+                   cls.AGE_50_59, cls.AGE_60_AND_OLDER)
+        app_ids = (cls.APP_UNKNOWN, cls.APP_IOS, cls.APP_ANDROID, cls.APP_MOBILE, cls.APP_BROWSER)
+        return MembersParser(cls.countries_ids, cls.UNKNOWN_COUNTRY, age_ids, app_ids)
+
+    def __init__(self, comm_vkid, members, updated=None):
         self.vkid = comm_vkid
         self.members = members
-        self.offset = 0
-        self.profile2count = {}
-        self.unfinished_tasks = math.ceil(members / STEP)
+        self.updated = updated
+        self.counter = None
+        self.parser = None
+        self.sample = None
+        self.seed = None
+        self.sampled = 0
+        self.tasks = sampled_tasks(members, STEP)
+        self.todo = deque(range(self.tasks))
+        self.done = []
+        self.unfinished_tasks = self.tasks
+        self.since_checkpoint = 0
+        self._restored_counts = None
+
+    @classmethod
+    async def load_checkpoints(cls, db, audiences):
+        # Crawls interrupted by a crash or a restart are resumed from their last checkpoint
+        vkid2aud = {aud.vkid: aud for aud in audiences}
+        sql = ('SELECT "community_vkid", "audience_updated", "members", "seed", "done", "sampled", "counts" '
+               'FROM "audience_checkpoint" '
+               'WHERE "community_vkid" = ANY(%s)')
+        rows = await db.execute(sql, (list(vkid2aud),), handler=lambda row: row)
+        for vkid, updated, members, seed, done, sampled, counts in rows:
+            aud = vkid2aud[vkid]
+            # A checkpoint of a crawl which has finished is useless. The number of members of a big community
+            # changes with almost every refresh, so the crawl goes on with the one it has started with
+            # to keep the offsets of the finished tasks
+            if updated != aud.updated:
+                continue
+            aud.members = members
+            aud.tasks = sampled_tasks(members, STEP)
+            aud.seed = seed
+            aud.done = list(done)
+            aud.sampled = sampled
+            done_set = set(done)
+            aud.todo = deque(i for i in range(aud.tasks) if i not in done_set)
+            aud.unfinished_tasks = len(aud.todo)
+            aud._restored_counts = bytes(counts)
+            logging.info('audience of community %s is resumed, %s of %s tasks are done' % (
+                vkid, len(aud.done), aud.tasks))
+
+    def start(self):
+        # Is called when the first offset is handed out
+        if self._restored_counts is not None:
+            self.counter = ProfileCounter.from_bytes(self._restored_counts)
+            self._restored_counts = None
+        else:
+            self.counter = ProfileCounter()
+        self.parser = self.make_parser()
+        if self.members >= AUDIENCE_SAMPLING_MIN_MEMBERS:
+            if self.seed is None:
+                self.seed = random.getrandbits(31)
+            self.sample = self._make_sample()
+
+    def _make_sample(self):
+        # Stratified: every task fetches random pages of its own part of the members,
+        # the seed makes the sample reproducible when the crawl is resumed
+        pages = math.ceil(self.members / PAGE)
+        rnd = random.Random(self.seed)
+        sample = []
+        for i in range(self.tasks):
+            first, last = pages * i // self.tasks, pages * (i + 1) // self.tasks
+            chosen = rnd.sample(range(first, last), min(STEP // PAGE, last - first))
+            sample.append(sorted(page * PAGE for page in chosen))
+        return sample
+
+    def has_offsets(self):
+        return bool(self.todo)
+
+    def take_offsets(self):
+        i = self.todo.popleft()
+        if self.sample is not None:
+            return i, self.sample[i]
+        return i, range(i * STEP, (i + 1) * STEP, PAGE)
+
+    def add_counts(self, counts, task):
+        self.counter.merge(counts)
+        # The members actually counted, the pages of a shrunk community come back short
+        self.sampled += sum(num for _, num in counts)
+        self.done.append(task)
+        self.since_checkpoint += 1
+
+    def checkpoint(self):
+        # Is called in the event loop, the returned function saves a snapshot in a transaction
+        self.since_checkpoint = 0
+        params = (self.vkid, self.updated, self.members, self.seed, list(self.done), self.sampled,
+                  self.counter.to_bytes())
+        return lambda db: self._save_checkpoint(db, params)
 
-    @Database.retry
-    def save(self):
-        if not self.profile2count:
+    @staticmethod
+    def _save_checkpoint(db, params):
+        sql = ('INSERT INTO "audience_checkpoint" '
+               '("community_vkid", "audience_updated", "members", "seed", "done", "sampled", "counts") '
+               'VALUES (%s, %s, %s, %s, %s, %s, %s) '
+               'ON CONFLICT ("community_vkid") DO UPDATE '
+               'SET "audience_updated" = EXCLUDED."audience_updated", "members" = EXCLUDED."members", '
+               '"seed" = EXCLUDED."seed", "done" = EXCLUDED."done", "sampled" = EXCLUDED."sampled", '
+               '"counts" = EXCLUDED."counts", "updated" = CURRENT_TIMESTAMP')
+        db.execute(sql, params)
+
+    def estimates(self):
+        # (profile id, count, margin of its 95% confidence interval or None when the count is exact)
+        if self.sample is None:
+            for pid, count in self.counter.items():
+                yield pid, count, None
+            return
+        population, sampled = max(self.members, self.sampled), max(self.sampled, 1)
+        scale = population / sampled
+        fpc = 1 - sampled / population
+        for pid, count in self.counter.items():
+            p = min(count / sampled, 1.0)
+            margin = 1.96 * population * math.sqrt(p * (1 - p) / sampled * fpc)
+            yield pid, max(round(count * scale), 1), round(margin)
+
+    def save(self, db):
+        if not self.counter:
             return
 
-        with Database() as db:
-            audience_params_list = []
-            sql = ('INSERT INTO "profile" ("sex_vkid", "age_range_id", "country_vkid", "app_id") '
-                   'VALUES (%s, %s, %s, %s) '
-                   'RETURNING "id"')
-            for profile, count in self.profile2count.items():
-                profile_id = self._profile2id.get(profile)
-                if profile_id is None:
-                    params = profile.sex_vkid, profile.age_range_id, profile.country_vkid, profile.app_id
-                    profile_id = db.execute(sql, params, lambda row: row[0])[0]
-                    self._profile2id[profile] = profile_id
-                audience_params_list.append((self.vkid, profile_id, count))
-
-            sql = ('DELETE FROM "audience" '
-                   'WHERE "community_vkid" = %s')
-            db.execute(sql, (self.vkid,))
-            sql = ('INSERT INTO "audience" ("community_vkid", "profile_id", "count") '
-                   'VALUES (%s, %s, %s)')
-            db.executemany(sql, audience_params_list)
-        logging.info('audience of community %s was saved' % self.vkid)
+        sql = ('CREATE TEMP TABLE "audience_new" ('
+               '"profile_id" int4 PRIMARY KEY, "count" int4, "margin" int4'
+               ') ON COMMIT DROP')
+        db.execute(sql)
+        data = io.StringIO(''.join(
+            '%d\t%d\t%s\n' % (pid, count, '\\N' if margin is None else margin)
+            for pid, count, margin in self.estimates()
+        ))
+        db.copy_expert('COPY "audience_new" ("profile_id", "count", "margin") FROM STDIN', data)
+
+        sql = ('DELETE FROM "audience" AS a '
+               'WHERE a."community_vkid" = %s '
+               'AND NOT EXISTS (SELECT 1 FROM "audience_new" AS n WHERE n."profile_id" = a."profile_id")')
+        db.execute(sql, (self.vkid,))
+        sql = ('UPDATE "audience" AS a '
+               'SET "count" = n."count", "margin" = n."margin" '
+               'FROM "audience_new" AS n '
+               'WHERE a."community_vkid" = %s '
+               'AND a."profile_id" = n."profile_id" '
+               'AND (a."count" <> n."count" OR a."margin" IS DISTINCT FROM n."margin")')
+        db.execute(sql, (self.vkid,))
+        sql = ('INSERT INTO "audience" ("community_vkid", "profile_id", "count", "margin") '
+               'SELECT %s, "profile_id", "count", "margin" '
+               'FROM "audience_new" '
+               'ON CONFLICT DO NOTHING')
+        db.execute(sql, (self.vkid,))
+        sql = 'SELECT refresh_audience_cube(%s)'
+        db.execute(sql, (self.vkid,))
+        sql = ('DELETE FROM "audience_checkpoint" '
+               'WHERE "community_vkid" = %s')
+        db.execute(sql, (self.vkid,))
+        # The trigger on "audience" doesn't fire when nothing new was inserted
+        sql = ('UPDATE "community" '
+               'SET "audience_updated" = CURRENT_TIMESTAMP '
+               'WHERE "vkid" = %s')
+        db.execute(sql, (self.vkid,))
+        if self.sample is None:
+            logging.info('audience of community %s was saved' % self.vkid)
+        else:
+            logging.info('audience of community %s was estimated from %s of %s members' % (
+                self.vkid, self.sampled, self.members))
 
 
 class TaskToUpdateAudience(BaseTask):
 
+    WEIGHT = AUDIENCE_WEIGHT
+    BUDGET = AUDIENCE_BUDGET
+    CALLS = STEP // PAGE
+
+    _TIME_FOR_FULL_UPDATE = TimeDelta(days=7)
+
     _audiences = deque()
+    _in_flight = []
+    _pending_tasks = 0
+    _leases = None
+    _planner = CrawlPlanner(STEP)
+    _next_load = None
 
-    _URL_PATTERN = (
-        'https://api.vk.com/method/execute?code={code}&v=5.67&access_token={token}'
-    )
-    _CODE_LINE = ('API.groups.getMembers({"group_id":%d,"offset":%d,"count":1000,"sort":"id_asc",'
-                  '"fields":"sex,bdate,country,last_seen"})')
+    @classmethod
+    async def prepare(cls, db):
+        if AudienceOfCommunity.UNKNOWN_COUNTRY is None:
+            await AudienceOfCommunity.init_countries_ids(db)
+            await AudienceOfCommunity.init_applications(db)
+            await AudienceOfCommunity.init_age_ranges(db)
+        if cls._leases is None:
+            cls._leases = Leases(db.loop, 'audience')
+        await cls._leases.renew(db)
+        if not cls._audiences and not cls._has_offsets():
+            now = DateTime.now(timezone.utc)
+            if cls._next_load is None or now >= cls._next_load:
+                await cls._load_audiences(db)
+
+    @classmethod
+    async def close(cls, db):
+        if cls._leases is not None:
+            for aud in cls._in_flight:
+                if aud.counter:
+                    await db.transaction(aud.checkpoint())
+            cls._audiences.clear()
+            await cls._leases.release_all(db)
+
+    @classmethod
+    def has_work(cls):
+        return cls._has_offsets() or (bool(cls._audiences) and len(cls._in_flight) < AUDIENCES_IN_FLIGHT)
+
+    @classmethod
+    def pending(cls):
+        return cls._pending_tasks
 
     @classmethod
     def deadline(cls):
-        return DateTime.now(timezone.utc) + TimeDelta(seconds=10)
+        # Every audience is to be updated within _TIME_FOR_FULL_UPDATE
+        aud = cls._offsets_owner() or cls._audiences[0]
+        return aud.updated + cls._TIME_FOR_FULL_UPDATE
 
     @classmethod
-    def _load_audiences(cls):
-        audiences = AudienceOfCommunity.load_ordered_by_update_time(50000)
-        logging.info('Loaded %s communities' % len(audiences))
+    async def _load_audiences(cls, db):
+        audiences = []
+        if await cls._planner.update_budget(db):
+            audiences = await AudienceOfCommunity.claim_by_priority(db, cls._leases, cls._planner,
+                                                                    AUDIENCES_CLAIM_SIZE)
+        if not audiences:
+            # The budget is spent or the other collectors have claimed everything
+            cls._next_load = DateTime.now(timezone.utc) + TimeDelta(seconds=MIN_RELOAD_INTERVAL)
+            return
+        audiences, rest = cls._planner.fit(audiences)
+        if rest:
+            vkids = [aud.vkid for aud in rest]
+            cls._leases.forget(vkids)
+            await db.transaction(lambda tx: cls._leases.release(tx, vkids))
+        if not audiences:
+            return
+        await AudienceOfCommunity.load_checkpoints(db, audiences)
+        logging.info('Claimed %s communities' % len(audiences))
         cls._audiences.extend(audiences)
+        cls._pending_tasks += sum(aud.unfinished_tasks for aud in audiences)
+        delay = DateTime.now(timezone.utc) - cls.deadline()
+        if delay > TimeDelta(0):
+            logging.warning('TaskToUpdateAudience missed the deadline by {0}'.format(delay))
 
-    def __init__(self):
-        super().__init__()
-        self.blank = False
-        self.aud = None
-        self.offset = None
-        self.response = None
-        if not self._audiences:
-            self._load_audiences()
-        self.aud = self._audiences[0]
-        if self.aud.offset >= self.aud.members:
-            self.blank = True
-        else:
-            self.offset = self.aud.offset
-            self.aud.offset += STEP
+    @classmethod
+    def _has_offsets(cls):
+        return any(aud.has_offsets() for aud in cls._in_flight)
 
-    async def handle(self, session, token):
-        if self.blank:
-            await asyncio.sleep(20)
-            return
-        url = self._url(token)
-        async with session.get(url) as resp:
-            resp.raise_for_status()
-            self.response = await resp.json()
-        self._handle_response()
-        logging.debug('TaskToUpdateAudience(%s) done, %s tasks left' % (self.aud.vkid, self.aud.unfinished_tasks))
+    @classmethod
+    def _offsets_owner(cls):
+        for aud in cls._in_flight:
+            if aud.has_offsets():
+                return aud
+        return None
 
-    def _url(self, token):
-        code = 'return ['
-        code += ','.join(
-            (self._CODE_LINE % (self.aud.vkid, offset))
-            for offset in range(self.offset, self.offset+STEP, 1000)
-        )
-        code += '];'
-        return self._URL_PATTERN.format(code=code, token=token)
-
-    def _handle_response(self):
-        parts = self.response.get('response')
-        if parts:
-            for part in parts:
-                if part:
-                    self._update_audience(part['items'])
-            self.aud.unfinished_tasks -= 1
-            if self.aud.unfinished_tasks == 0:
-                self.aud.save()
-                self._audiences.popleft()
-        else:
-            self._handle_error()
-
-    def _update_audience(self, users):
-        for user in users:
-            try:
-                sex_vkid = self._parse_sex(user)
-                age_range_id = self._parse_bdate(user)
-                country_vkid = self._parse_country(user)
-                app_id = self._parse_last_platform(user)
-                profile = Profile(sex_vkid, age_range_id, country_vkid, app_id)
-                self.aud.profile2count[profile] = self.aud.profile2count.get(profile, 0) + 1
-            except errors.VKAPIParsingError as err:
-                logging.error(err)
+    @classmethod
+    def _next_audience(cls):
+        # Offsets are handed out in the order the communities were started,
+        # a new community is started as soon as the others have no offsets left
+        aud = cls._offsets_owner()
+        if aud is not None:
+            return aud
+        if cls._audiences and len(cls._in_flight) < AUDIENCES_IN_FLIGHT:
+            aud = cls._audiences.popleft()
+            aud.start()
+            cls._in_flight.append(aud)
+            logging.debug('TaskToUpdateAudience(%s) started, %s communities in flight' % (
+                aud.vkid, len(cls._in_flight)))
+            return aud
+        return None
 
-    @staticmethod
-    def _parse_sex(user):
-        sex_id = user.get('sex')
-        if sex_id not in (0, 1, 2):
-            raise errors.VKAPIParsingError('unexpected value of "sex": %s' % sex_id)
-        return sex_id
+    def __init__(self):
+        super().__init__()
+        # The scheduler creates a task only if has_work() is true
+        self.aud = self._next_audience()
+        self.index, self.offsets = self.aud.take_offsets()
+        TaskToUpdateAudience._pending_tasks -= 1
+
+    def calls(self):
+        return [Call('groups.getMembers', {'group_id': self.aud.vkid, 'offset': offset, 'count': PAGE,
+                                           'sort': 'id_asc', 'fields': 'sex,bdate,country,last_seen'})
+                for offset in self.offsets]
+
+    def reducer(self):
+        # The members are counted by the parsing executor
+        return count_members, (self.aud.parser,)
+
+    async def handle_results(self, counts, call_errors, db):
+        if call_errors:
+            self._handle_error(call_errors[0])
+        await self._handle_counts(counts, db)
+        logging.debug('TaskToUpdateAudience(%s) done, %s tasks left' % (self.aud.vkid, self.aud.unfinished_tasks))
 
-    @staticmethod
-    def _parse_bdate(user):
-        bdate = user.get('bdate')
-        if bdate is None:
-            return AudienceOfCommunity.AGE_UNKNOWN
-        parts = bdate.split('.')
-        if len(parts) < 3:
-            return AudienceOfCommunity.AGE_UNKNOWN
-        try:
-            bdate = DateTime(int(parts[2]), int(parts[1]), int(parts[0]))
-        except ValueError:
-            return AudienceOfCommunity.AGE_UNKNOWN
-        now = DateTime.utcnow()
-        if bdate > now:
-            return AudienceOfCommunity.AGE_UNKNOWN
-        age = (now - bdate).days / 365.25
-        if age < 15:
-            return AudienceOfCommunity.AGE_14_AND_YOUNGER
-        if age < 18:
-            return AudienceOfCommunity.AGE_15_17
-        if age < 22:
-            return AudienceOfCommunity.AGE_18_21
-        if age < 26:
-            return AudienceOfCommunity.AGE_22_25
-        if age < 30:
-            return AudienceOfCommunity.AGE_26_29
-        if age < 35:
-            return AudienceOfCommunity.AGE_30_34
-        if age < 40:
-            return AudienceOfCommunity.AGE_35_39
-        if age < 45:
-            return AudienceOfCommunity.AGE_40_44
-        if age < 50:
-            return AudienceOfCommunity.AGE_45_49
-        if age < 60:
-            return AudienceOfCommunity.AGE_50_59
-        return AudienceOfCommunity.AGE_60_AND_OLDER
+    async def _handle_counts(self, counts, db):
+        self.aud.add_counts(counts, self.index)
+        self.aud.unfinished_tasks -= 1
+        if self.aud.unfinished_tasks == 0:
+            await self._finish(db)
+        elif self.aud.since_checkpoint >= AUDIENCE_CHECKPOINT_TASKS:
+            await db.write(self.aud.checkpoint())
+
+    async def _finish(self, db):
+        self._in_flight.remove(self.aud)
+        # Without any counts the lease is left to expire
+        self._leases.forget((self.aud.vkid,))
+        if self.aud.counter:
+            await db.write(self._save)
+
+    def _save(self, db):
+        self.aud.save(db)
+        self._planner.log_crawl(db, self.aud.vkid, self.aud.tasks)
+        self._leases.release(db, (self.aud.vkid,))
+        advance_data_version(db)
 
     @staticmethod
-    def _parse_country(user):
-        country = user.get('country')
-        if country is None:
-            return AudienceOfCommunity.UNKNOWN_COUNTRY
-        country_id = country['id']
-        if country_id in AudienceOfCommunity.countries_ids:
-            return country_id
-        else:
-            return AudienceOfCommunity.UNKNOWN_COUNTRY
+    def _handle_error(err):
+        raise errors.response_error(err)
 
-    @staticmethod
-    def _parse_last_platform(user):
-        last_seen = user.get('last_seen')
-        if last_seen is None:
-            return AudienceOfCommunity.APP_UNKNOWN
-        platform_id = last_seen.get('platform')
-        if platform_id is None or platform_id == 6:
-            return AudienceOfCommunity.APP_UNKNOWN
-        if platform_id in (2, 3):
-            return AudienceOfCommunity.APP_IOS
-        if platform_id == 4:
-            return AudienceOfCommunity.APP_ANDROID
-        if platform_id in (1, 5, 8):
-            return AudienceOfCommunity.APP_MOBILE
-        if platform_id == 7:
-            return AudienceOfCommunity.APP_BROWSER
-        raise errors.VKAPIParsingError('unknown platform_id: %s' % platform_id)
-
-    def _handle_error(self):
-        errmsg = 'Unknown VKAPI error'
-        err = self.response.get('error')
-        if err:
-            errmsg = err.get('error_msg', errmsg)
-        raise errors.VKAPIResponseError(errmsg)
-
-    def cancel(self):
+    async def cancel(self, db):
         self.aud.unfinished_tasks -= 1
         logging.debug('TaskToUpdateAudience(id%s) was cancelled, %s tasks left' % (self.aud.vkid, self.aud.unfinished_tasks))
         if self.aud.unfinished_tasks == 0:
-            self.aud.save()
-            self._audiences.popleft()
+            await self._finish(db)
@@ -1,10 +1,42 @@
 class BaseTask:
 
+    WEIGHT = 1
+    BUDGET = None  # max tasks in flight
+    CALLS = 1  # API calls the task packs into an "execute" request
+
+    @classmethod
+    async def prepare(cls, db):
+        pass
+
+    @classmethod
+    async def close(cls, db):
+        pass
+
+    @classmethod
+    def has_work(cls):
+        return True
+
+    @classmethod
+    def pending(cls):
+        return 0
+
+    @classmethod
+    def deadline(cls):
+        raise NotImplementedError()
+
     def __init__(self):
         self.tries = 0
+        self.due = None
+
+    def calls(self):
+        raise NotImplementedError()
+
+    def reducer(self):
+        # None or (fn, args): fn(*args, results of the calls) is run by the parsing executor
+        return None
 
-    def handle(self, session, token):
+    def handle_results(self, results, call_errors, db):
         raise NotImplementedError()
 
-    def cancel(self):
+    def cancel(self, db):
         raise NotImplementedError()
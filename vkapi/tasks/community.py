@@ -1,42 +1,62 @@
+import hashlib
 import logging
 import math
+from array import array
 from datetime import datetime as DateTime, timedelta as TimeDelta, timezone
-from queue import deque
 
 from vkapi import errors
-from vkapi.db import Database
+from vkapi.dataversion import advance_data_version
+from vkapi.db import WriteBehindBuffer
+from vkapi.lease import Leases
+from vkapi.refresh import RefreshPlanner, community_state
 from vkapi.tasks.basetask import BaseTask
+from vkapi.tasks.execute import Call
+from vkapi.config import COMMUNITIES_FLUSH_SIZE
+from vkapi.config import COMMUNITIES_FLUSH_DELAY
+from vkapi.config import COMMUNITIES_WEIGHT
+from vkapi.config import COMMUNITIES_BUDGET
+from vkapi.config import MIN_RELOAD_INTERVAL
+from vkapi.config import COMMUNITIES_CLAIM_SIZE
+from vkapi.config import REFRESH_PLAN_INTERVAL
 
 
 class Community:
 
+    __slots__ = ('vkid', 'refresh_interval', 'previous', 'changed', 'fingerprint', 'modified',
+                 'deactivated', 'type', 'name', 'description', 'members', 'status', 'verified', 'site', 'age_limit')
+
     PUBLIC_PAGE = None
     OPEN_GROUP = None
     CLOSED_GROUP = None
     PRIVATE_GROUP = None
 
     @classmethod
-    def _init_types(cls):
+    async def init_types(cls, db):
         sql = ('SELECT "id", "name" '
                'FROM "community_type"')
-        kvpairs = Database().execute(sql, handler=lambda row: (row[1], row[0]))
+        kvpairs = await db.execute(sql, handler=lambda row: (row[1], row[0]))
         name2id = dict(kvpairs)
         cls.PUBLIC_PAGE = name2id['PUBLIC_PAGE']
         cls.OPEN_GROUP = name2id['OPEN_GROUP']
         cls.CLOSED_GROUP = name2id['CLOSED_GROUP']
         cls.PRIVATE_GROUP = name2id['PRIVATE_GROUP']
 
-    @classmethod
-    def load_ordered_by_update_time(cls):
-        sql = ('SELECT "vkid" '
-               'FROM "community" '
-               'ORDER BY "updated" ASC')
-        return Database().execute(sql, handler=lambda row: cls(row[0]))
+    @staticmethod
+    async def claim_ordered_by_next_update(db, leases, limit):
+        columns = ('c."vkid", c."deactivated", c."name", c."status", c."members", '
+                   'r."interval", r."next_update", r."fingerprint"')
+        # Only the communities which are due, the intervals are what saves the requests
+        return await leases.claim(db, columns, 'r."next_update" <= CURRENT_TIMESTAMP', '"next_update" ASC', limit,
+                                  handler=lambda row: row,
+                                  join='JOIN "community_refresh" AS r ON r."community_vkid" = c."vkid"')
 
     def __init__(self, vkid):
-        if self.PUBLIC_PAGE is None:
-            self._init_types()
         self.vkid = vkid
+        self.refresh_interval = None
+        self.previous = None
+        self.changed = None
+        self.fingerprint = None
+        self.modified = None
         self.deactivated = None
         self.type = None
         self.name = None
@@ -48,7 +68,7 @@ class Community:
         self.age_limit = None
 
     @classmethod
-    def create(cls, vkid, deactivated, type_, name, description, members, status, verified, site, age_limit):
+    def create(cls, db, vkid, deactivated, type_, name, description, members, status, verified, site, age_limit):
         comm = cls(vkid)
         comm.deactivated = deactivated
         comm.type = type_
@@ -66,94 +86,195 @@ class Community:
                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)')
         params = (comm.vkid, comm.deactivated, comm.type, comm.name, comm.description,
                   comm.members, comm.status, comm.verified, comm.site, comm.age_limit)
-        Database().execute(sql, params)
+        db.execute(sql, params)
 
         return comm
 
-    def save(self):
-        sql = ('UPDATE "community" '
-               'SET "deactivated"=%s, "type"=%s, "name"=%s, "description"=%s, '
-               '"members"=%s, "status"=%s, "verified"=%s, "site"=%s, "age_limit"=%s '
-               'WHERE "vkid"=%s')
-        params = (self.deactivated, self.type, self.name, self.description,
-                  self.members, self.status, self.verified, self.site, self.age_limit,
-                  self.vkid)
-        Database().execute(sql, params)
-        logging.info('community(id%s) was saved' % self.vkid)
+    def make_fingerprint(self):
+        # Must be the same in every process, so hash() of str doesn't fit
+        fields = (self.deactivated, self.type, self.name, self.description,
+                  self.members, self.status, self.verified, self.site, self.age_limit)
+        digest = hashlib.blake2b(repr(fields).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True)
+
+    @staticmethod
+    def save_many(db, communities):
+        sql = ('UPDATE "community" AS c '
+               'SET "deactivated"=v."deactivated", "type"=v."type", "name"=v."name", '
+               '"description"=v."description", "members"=v."members", "status"=v."status", '
+               '"verified"=v."verified", "site"=v."site", "age_limit"=v."age_limit" '
+               'FROM (VALUES %s) AS v ("vkid", "deactivated", "type", "name", "description", '
+               '"members", "status", "verified", "site", "age_limit") '
+               'WHERE c."vkid"=v."vkid"')
+        template = ('(%s::int4, %s::boolean, %s::int2, %s::text, %s::text, '
+                    '%s::int4, %s::text, %s::boolean, %s::text, %s::int2)')
+        params_list = [(comm.vkid, comm.deactivated, comm.type, comm.name, comm.description,
+                        comm.members, comm.status, comm.verified, comm.site, comm.age_limit)
+                       for comm in communities]
+        db.execute_values(sql, params_list, template)
+        # "audience_cube.perc" follows "members" like the searches which compute the percentage themselves
+        sql = ('UPDATE "audience_cube" AS q '
+               'SET "perc" = 100::int8 * q."total" / NULLIF(c."members", 0) '
+               'FROM "community" AS c '
+               'WHERE c."vkid" = q."community_vkid" AND c."vkid" = ANY(%s) '
+               'AND q."perc" IS DISTINCT FROM 100::int8 * q."total" / NULLIF(c."members", 0)')
+        db.execute(sql, ([comm.vkid for comm in communities],))
+
+
+class CommunityQueue:
+    # The claimed communities are kept in arrays,
+    # Community objects are built only for the batch of a task
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.vkids = array('i')
+        self.members = array('i')  # -1: unknown
+        self.states = array('q')
+        self.intervals = array('f')
+        self.next_updates = array('d')  # timestamps
+        self.fingerprints = array('q')  # 0: unknown
+        self.head = 0
+
+    def __len__(self):
+        return len(self.vkids) - self.head
+
+    def extend(self, rows):
+        for vkid, deactivated, name, status, members, interval, next_update, fingerprint in rows:
+            self.vkids.append(vkid)
+            self.members.append(-1 if members is None else members)
+            self.states.append(community_state(deactivated, name, status))
+            self.intervals.append(interval)
+            self.next_updates.append(next_update.timestamp())
+            self.fingerprints.append(fingerprint or 0)
+
+    def next_update(self):
+        return DateTime.fromtimestamp(self.next_updates[self.head], timezone.utc)
+
+    def pop_batch(self, num):
+        end = min(self.head + num, len(self.vkids))
+        batch = []
+        for i in range(self.head, end):
+            comm = Community(self.vkids[i])
+            members = self.members[i]
+            comm.previous = (self.states[i], None if members < 0 else members)
+            comm.refresh_interval = self.intervals[i]
+            comm.fingerprint = self.fingerprints[i]
+            batch.append(comm)
+        self.head = end
+        if self.head == len(self.vkids):
+            self.clear()
+        return batch
 
 
 class TaskToUpdateCommunities(BaseTask):
 
+    WEIGHT = COMMUNITIES_WEIGHT
+    BUDGET = COMMUNITIES_BUDGET
     _COMMUNITIES_PER_TASK = 350
-    _TIME_FOR_FULL_UPDATE = TimeDelta(days=1)
 
-    _URL_PATTERN = (
-        'https://api.vk.com/method/groups.getById?group_ids={ids}&'
-        'fields=type,is_closed,name,description,members_count,status,verified,site,age_limits&'
-        'v=5.67&access_token={token}')
+    _communities = CommunityQueue()
+    _leases = None
+    _planner = None
+    _next_plan = None
+    _next_load = None
+    _writer = None
 
-    _communities = deque()
-    _main_deadline = None
-    _max_time_per_task = None
+    @classmethod
+    async def prepare(cls, db):
+        if Community.PUBLIC_PAGE is None:
+            await Community.init_types(db)
+        if cls._leases is None:
+            cls._leases = Leases(db.loop, 'community')
+        if cls._writer is None:
+            cls._writer = WriteBehindBuffer(db, 'communities', cls._save_many,
+                                            COMMUNITIES_FLUSH_SIZE, COMMUNITIES_FLUSH_DELAY)
+        if cls._planner is None:
+            cls._planner = RefreshPlanner(cls._COMMUNITIES_PER_TASK)
+        await cls._leases.renew(db)
+        now = DateTime.now(timezone.utc)
+        if cls._next_plan is None or now >= cls._next_plan:
+            cls._next_plan = now + TimeDelta(seconds=REFRESH_PLAN_INTERVAL)
+            await cls._planner.plan(db)
+        if not cls._communities:
+            if cls._next_load is None or now >= cls._next_load:
+                await cls._load_communities(db)
+
+    @classmethod
+    async def close(cls, db):
+        if cls._writer is not None:
+            await cls._writer.flush()
+        if cls._leases is not None:
+            cls._communities.clear()
+            await cls._leases.release_all(db)
+
+    @classmethod
+    def has_work(cls):
+        # Scheduler.poll() must not pack batches that aren't due yet into spare calls either
+        return bool(cls._communities) and cls._communities.next_update() <= DateTime.now(timezone.utc)
+
+    @classmethod
+    def pending(cls):
+        return math.ceil(len(cls._communities) / cls._COMMUNITIES_PER_TASK)
 
     @classmethod
     def deadline(cls):
-        if not cls._communities:
-            cls._load_communities()
-        ntasks = math.ceil(len(cls._communities) / cls._COMMUNITIES_PER_TASK)
-        deadline = cls._main_deadline - cls._max_time_per_task * ntasks
-        return deadline
+        # The claimed communities are ordered by the planned update time
+        return cls._communities.next_update()
 
     @classmethod
-    def _load_communities(cls):
-        communities = Community.load_ordered_by_update_time()
+    async def _load_communities(cls, db):
+        communities = await Community.claim_ordered_by_next_update(db, cls._leases, COMMUNITIES_CLAIM_SIZE)
+        if not communities:
+            # The other collectors have claimed everything
+            cls._next_load = DateTime.now(timezone.utc) + TimeDelta(seconds=MIN_RELOAD_INTERVAL)
+            return
         cls._communities.extend(communities)
-        cls._update_main_deadline()
+        delay = DateTime.now(timezone.utc) - cls.deadline()
+        if delay > TimeDelta(0):
+            logging.warning('TaskToUpdateCommunities missed the deadline by {0}'.format(delay))
+        logging.info('Claimed %s communities' % len(communities))
 
     @classmethod
-    def _update_main_deadline(cls):
-        now = DateTime.now(timezone.utc)
-        if cls._main_deadline is not None and now > cls._main_deadline:
-            delay = now - cls._main_deadline
-            logging.warning('TaskToUpdateCommunities missed the deadline by {0}'.format(delay))
-        cls._main_deadline = now + cls._TIME_FOR_FULL_UPDATE
-        ntasks = math.ceil(len(cls._communities) / cls._COMMUNITIES_PER_TASK)
-        cls._max_time_per_task = cls._TIME_FOR_FULL_UPDATE / ntasks
+    def _save_many(cls, db, communities):
+        # The unmodified communities are only marked as checked in "community_refresh",
+        # rewriting them would leave dead tuples behind for nothing
+        modified = [comm for comm in communities if comm.modified]
+        if modified:
+            Community.save_many(db, modified)
+        logging.debug('Rewrote %s of %s refreshed communities' % (len(modified), len(communities)))
+        cls._planner.save_many(db, communities)
+        cls._leases.release(db, (comm.vkid for comm in communities))
+        if modified:
+            advance_data_version(db)
 
     def __init__(self):
         super().__init__()
-        if not self._communities:
-            self._load_communities()
         self.id2community = {}
-        self.response = None
         self._get_communities()
 
     def _get_communities(self):
-        num = min(self._COMMUNITIES_PER_TASK, len(self._communities))
-        for _ in range(num):
-            comm = self._communities.popleft()
+        for comm in self._communities.pop_batch(self._COMMUNITIES_PER_TASK):
             self.id2community[comm.vkid] = comm
 
-    async def handle(self, session, token):
-        url = self._url(token)
-        async with session.get(url) as resp:
-            resp.raise_for_status()
-            self.response = await resp.json()
-        self._handle_response()
-
-    def _url(self, token):
+    def calls(self):
         ids_param = ','.join(str(vkid) for vkid in self.id2community.keys())
-        return self._URL_PATTERN.format(ids=ids_param, token=token)
+        fields = 'type,is_closed,name,description,members_count,status,verified,site,age_limits'
+        return [Call('groups.getById', {'group_ids': ids_param, 'fields': fields})]
 
-    def _handle_response(self):
-        data_list = self.response.get('response')
+    async def handle_results(self, results, call_errors, db):
+        data_list = results[0] if results else None
         if data_list:
             id2data = {d['id']: d for d in data_list}
             for vkid, comm in self.id2community.items():
                 data = id2data[vkid]
-                self._update_community(comm, data)
+                if self._update_community(comm, data):
+                    await self._writer.add(vkid, comm)
+            # The lease is released when the update is flushed or expires
+            self._leases.forget(self.id2community)
         else:
-            self._handle_error()
+            self._handle_error(call_errors[0] if call_errors else None)
 
     def _update_community(self, comm, data):
         try:
@@ -166,9 +287,14 @@ class TaskToUpdateCommunities(BaseTask):
             comm.verified = self._parse_verified(data)
             comm.site = data.get('site', '')
             comm.age_limit = self._parse_age_limit(data)
-            comm.save()
+            fingerprint = comm.make_fingerprint()
+            comm.modified = fingerprint != comm.fingerprint
+            comm.fingerprint = fingerprint
+            self._planner.observe(comm)
+            return True
         except errors.VKAPIParsingError as err:
             logging.error(err)
+            return False
 
     @staticmethod
     def _parse_deactivated(data):
@@ -221,12 +347,10 @@ class TaskToUpdateCommunities(BaseTask):
             raise errors.VKAPIParsingError('Unknown "age_limits"=%s' % code)
         return limit
 
-    def _handle_error(self):
-        errmsg = 'Unknown VKAPI error'
-        err = self.response.get('error')
-        if err:
-            errmsg = err.get('error_msg', errmsg)
-        raise errors.VKAPIResponseError(errmsg)
+    @staticmethod
+    def _handle_error(err):
+        raise errors.response_error(err)
 
-    def cancel(self):
+    async def cancel(self, db):
+        self._leases.forget(self.id2community)
         logging.debug('TaskToUpdateCommunities was cancelled')
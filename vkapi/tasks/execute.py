@@ -0,0 +1,65 @@
+import json
+
+from vkapi import errors
+
+
+MAX_CALLS = 25  # API calls in an "execute" request
+URL = 'https://api.vk.com/method/execute'
+VERSION = '5.67'
+
+
+class Call:
+
+    __slots__ = ('method', 'params')
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+
+    def code(self):
+        return 'API.%s(%s)' % (self.method, json.dumps(self.params, ensure_ascii=False, separators=(',', ':')))
+
+
+def make_code(calls):
+    return 'return [%s];' % ','.join(call.code() for call in calls)
+
+
+async def send(session, token, tasks, parsing):
+    # Sends the calls of the tasks as a single "execute" request,
+    # returns (result, call errors) of every task
+    calls = [call for task in tasks for call in task.calls()]
+    data = {'code': make_code(calls), 'v': VERSION, 'access_token': token}
+    async with session.post(URL, data=data) as resp:
+        resp.raise_for_status()
+        raw = await resp.read()
+    groups = [(task.reducer(), len(task.calls())) for task in tasks]
+    # The response is decoded and reduced outside of the event loop
+    results, err = await parsing.run(reduce_response, raw, groups)
+    if results is None:
+        raise errors.response_error(err)
+    return results
+
+
+def reduce_response(raw, groups):
+    # Is run by ParsingExecutor. groups: (reducer, number of calls) of every task,
+    # a reducer is None or (fn, args) which is called as fn(*args, results of the calls)
+    response = json.loads(raw.decode('utf-8'))
+    parts = response.get('response')
+    if parts is None:
+        return None, response.get('error')
+    # A failed call returns false, its error is the next one in "execute_errors"
+    call_errors = iter(response.get('execute_errors', ()))
+    results, start = [], 0
+    for reducer, num in groups:
+        group, group_errors = [], []
+        for part in parts[start:start + num]:
+            if part is False:
+                group_errors.append(next(call_errors, None))
+            else:
+                group.append(part)
+        start += num
+        if reducer is not None:
+            fn, args = reducer
+            group = fn(*args, group)
+        results.append((group, group_errors))
+    return results, None
@@ -1,36 +1,165 @@
 import asyncio
-from datetime import datetime as DateTime
-from queue import deque
+import logging
 
-from vkapi.db import Database
+from vkapi import errors
 from vkapi.config import REQUEST_DELAY_PER_TOKEN
+from vkapi.config import TOKEN_SLOTS_PER_RESERVATION
+from vkapi.config import TOKEN_MAX_RATE
+from vkapi.config import TOKEN_MIN_RATE
+from vkapi.config import TOKEN_RATE_STEP
+from vkapi.config import TOKEN_COOLDOWNS
+from vkapi.config import TOKEN_MAX_COOLDOWN
+from vkapi.config import TOKENS_RELOAD_INTERVAL
+
+
+class TokenBucket:
+    # Requests are sent in the time slots reserved in "account",
+    # so a token never exceeds its rate however many collectors use it
+
+    __slots__ = ('token', 'rate', 'next_slot', 'slots', 'successes', 'strikes', 'cooldown_until')
+
+    def __init__(self, token):
+        self.token = token
+        self.rate = None
+        self.next_slot = 0.0
+        self.slots = 0
+        self.successes = 0
+        self.strikes = 0
+        self.cooldown_until = 0.0
+
+    def available_at(self, now):
+        # The slots which have passed unused are lost
+        while self.slots and self.next_slot + 1 / self.rate < now:
+            self.slots -= 1
+            self.next_slot += 1 / self.rate
+        if not self.slots:
+            return max(now, self.cooldown_until)
+        return max(now, self.next_slot)
+
+    def take(self):
+        self.slots -= 1
+        self.next_slot += 1 / self.rate
+
+    def reserved(self, now, delay, rate, slots):
+        self.rate = rate
+        # A reservation which was in flight during the throttling mustn't skip the cooldown
+        self.next_slot = max(now + max(delay, 0.0), self.cooldown_until)
+        self.slots = slots
+        self.successes = 0
+
+    def succeeded(self):
+        self.strikes = 0
+        self.successes += 1
+
+    def throttled(self, now, code):
+        self.strikes += 1
+        self.slots = 0
+        cooldown = min(TOKEN_COOLDOWNS.get(code, 1) * 2 ** (self.strikes - 1), TOKEN_MAX_COOLDOWN)
+        self.cooldown_until = max(self.cooldown_until, now + cooldown)
+        return cooldown
 
 
 class TokenPool:
 
     def __init__(self, loop):
         self.loop = loop
-        self.tokens = None
-        self.sem = None
-        self._load()
+        self.buckets = {}
+        self.reservations = 0
+        self._lock = asyncio.Lock(loop=loop)
 
-    def _load(self):
+    async def load(self, db):
         sql = ('SELECT "token" '
                'FROM "account" '
                'WHERE "active" = TRUE')
-        tokens = Database().execute(sql, handler=lambda t: t[0])
-        self.tokens = deque((t, DateTime(1970, 1, 1)) for t in tokens)
-        self.sem = asyncio.BoundedSemaphore(len(tokens), loop=self.loop)
+        tokens = await db.execute(sql, handler=lambda t: t[0])
+        for tk in tokens:
+            if tk not in self.buckets:
+                self.buckets[tk] = TokenBucket(tk)
+        for tk in set(self.buckets).difference(tokens):
+            del self.buckets[tk]
+        logging.info('%s active tokens' % len(self.buckets))
+
+    async def reload_periodically(self, db):
+        while True:
+            await asyncio.sleep(TOKENS_RELOAD_INTERVAL, loop=self.loop)
+            try:
+                await self.load(db)
+            except Exception as err:
+                logging.exception(err)
 
     def __len__(self):
-        return len(self.tokens)
-
-    async def get(self):
-        async with self.sem:
-            tk, dt = self.tokens.popleft()
-            delta = (DateTime.utcnow() - dt).total_seconds()
-            delay = REQUEST_DELAY_PER_TOKEN - delta
-            if delay > 0:
-                await asyncio.sleep(delay, loop=self.loop)
-            self.tokens.append((tk, DateTime.utcnow()))
-            return tk
+        return len(self.buckets)
+
+    async def get(self, db):
+        async with self._lock:
+            while True:
+                now = self.loop.time()
+                if not self.buckets:
+                    await asyncio.sleep(1, loop=self.loop)
+                    continue
+                bucket = min(self.buckets.values(), key=lambda b: b.available_at(now))
+                if not bucket.slots:
+                    await self._reserve(db, bucket)
+                    continue
+                available_at = bucket.available_at(now)
+                if available_at <= now:
+                    bucket.take()
+                    return bucket.token
+                await asyncio.sleep(available_at - now, loop=self.loop)
+
+    async def _reserve(self, db, bucket):
+        # Reserves the next slots of the token after the ones reserved by the other collectors,
+        # the rate is raised a little for every success since the last reservation
+        sql = ('UPDATE "account" '
+               'SET "rate" = LEAST(%(max_rate)s, COALESCE("rate", %(rate)s) + %(step)s * %(successes)s), '
+               '"next_request" = GREATEST("next_request", "cooldown_until", clock_timestamp()) '
+               '+ %(slots)s / LEAST(%(max_rate)s, COALESCE("rate", %(rate)s) + %(step)s * %(successes)s) '
+               '* INTERVAL \'1 second\' '
+               'WHERE "token" = %(token)s AND "active" = TRUE '
+               'RETURNING EXTRACT(EPOCH FROM "next_request" - clock_timestamp())::float8 - %(slots)s / "rate", '
+               '"rate"')
+        params = {'token': bucket.token, 'slots': TOKEN_SLOTS_PER_RESERVATION, 'successes': bucket.successes,
+                  'rate': 1 / REQUEST_DELAY_PER_TOKEN, 'max_rate': TOKEN_MAX_RATE, 'step': TOKEN_RATE_STEP}
+        rows = await db.execute(sql, params, handler=lambda row: row)
+        self.reservations += 1
+        if not rows:
+            # Has been deactivated by another collector
+            self.buckets.pop(bucket.token, None)
+            return
+        delay, rate = rows[0]
+        bucket.reserved(self.loop.time(), delay, rate, TOKEN_SLOTS_PER_RESERVATION)
+
+    def succeeded(self, token):
+        bucket = self.buckets.get(token)
+        if bucket is not None:
+            bucket.succeeded()
+
+    async def failed(self, token, err, db):
+        bucket = self.buckets.get(token)
+        if bucket is None:
+            return
+        if isinstance(err, errors.VKAPIAuthError):
+            del self.buckets[token]
+            logging.warning('token %s... is revoked, %s tokens left' % (token[:8], len(self.buckets)))
+            await db.transaction(lambda tx: self._deactivate(tx, token))
+        elif isinstance(err, errors.VKAPIThrottlingError):
+            cooldown = bucket.throttled(self.loop.time(), err.code)
+            logging.warning('token %s... is throttled (%s), cooldown %ss' % (token[:8], err.code, cooldown))
+            # Committed before the next reservation of the token, which starts after "cooldown_until"
+            await db.transaction(lambda tx: self._throttle(tx, token, cooldown))
+
+    @staticmethod
+    def _deactivate(db, token):
+        sql = ('UPDATE "account" '
+               'SET "active" = FALSE '
+               'WHERE "token" = %s')
+        db.execute(sql, (token,))
+
+    @staticmethod
+    def _throttle(db, token, cooldown):
+        # The rate is halved and the token rests for all the collectors
+        sql = ('UPDATE "account" '
+               'SET "rate" = GREATEST(%s, COALESCE("rate", %s) / 2), '
+               '"cooldown_until" = GREATEST("cooldown_until", clock_timestamp() + %s * INTERVAL \'1 second\') '
+               'WHERE "token" = %s')
+        db.execute(sql, (TOKEN_MIN_RATE, 1 / REQUEST_DELAY_PER_TOKEN, cooldown, token))
@@ -1,53 +1,153 @@
 import asyncio
 import logging
-from queue import deque
 
 import aiohttp
+import psycopg2
 
 from vkapi import errors
+from vkapi.autotuner import ConcurrencyController
+from vkapi.parser import ParsingExecutor
+from vkapi.scheduler import Scheduler
 from vkapi.tokenpool import TokenPool
+from vkapi.tasks import execute
 from vkapi.config import REQUEST_TIMEOUT
 from vkapi.config import WORKERS_PER_TOKEN
-from vkapi.config import TRIES_PER_TASK
+from vkapi.config import MAX_WORKERS_PER_TOKEN
+from vkapi.config import AUTOTUNE_INTERVAL
+from vkapi.config import DB_WRITE_QUEUE_SIZE
+from vkapi.config import STATS_INTERVAL
+from vkapi.config import SCHEDULER_IDLE_DELAY
 
 
 class VKAPIClient:
 
-    def __init__(self, loop, task_classes):
+    def __init__(self, loop, task_classes, db):
         self.loop = loop
         self.task_classes = task_classes
+        self.db = db
         self.token_pool = TokenPool(loop)
-        self.buffer = deque()
+        self.scheduler = Scheduler(loop, task_classes)
+        self.controller = None
+        self.parsing = ParsingExecutor(loop)
+        self._workers = []
 
     async def run(self):
+        await self.token_pool.load(self.db)
+        self.db.start()
+        self.controller = ConcurrencyController(self.loop, max(WORKERS_PER_TOKEN * len(self.token_pool), 1))
         async with aiohttp.ClientSession(read_timeout=REQUEST_TIMEOUT, loop=self.loop) as session:
-            num = WORKERS_PER_TOKEN * len(self.token_pool)
-            workers = [self._worker(session) for _ in range(num)]
-            await asyncio.wait(workers, loop=self.loop)
+            await asyncio.wait([
+                self._supervise(session),
+                self._report(),
+                self.token_pool.reload_periodically(self.db)
+            ], loop=self.loop)
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        for cls in self.task_classes:
+            await cls.close(self.db)
+        self.parsing.shutdown()
+
+    async def _supervise(self, session):
+        idle_waits = self.scheduler.idle_waits
+        while True:
+            # The workers which have died are replaced
+            for worker in self._workers:
+                if worker.done() and not worker.cancelled() and worker.exception() is not None:
+                    logging.error('a worker has died', exc_info=worker.exception())
+            self._workers = [w for w in self._workers if not w.done()]
+            # Workers above the limit just wait in the controller
+            while len(self._workers) < self.controller.limit:
+                self._workers.append(asyncio.ensure_future(self._worker(session), loop=self.loop))
+            await asyncio.sleep(AUTOTUNE_INTERVAL, loop=self.loop)
+            busy = self.scheduler.idle_waits == idle_waits
+            idle_waits = self.scheduler.idle_waits
+            max_workers = MAX_WORKERS_PER_TOKEN * max(len(self.token_pool), 1)
+            db_load = self.db.pending_writes() / DB_WRITE_QUEUE_SIZE
+            await self.controller.adjust(max_workers, db_load, busy)
 
     async def _worker(self, session):
         while True:
-            if self.buffer:
-                task = self.buffer.popleft()
-            else:
-                task = self._get_highest_priority_task()
-            token = await self.token_pool.get()
+            await self.controller.acquire()
+            try:
+                await self._handle_next_task(session)
+            except Exception as err:
+                # The worker outlives the failures of the database, the tasks it took are retried
+                logging.exception(err)
+                await asyncio.sleep(SCHEDULER_IDLE_DELAY, loop=self.loop)
+            finally:
+                await self.controller.release()
+
+    async def _handle_next_task(self, session):
+        # The calls of several tasks are packed into one "execute" request
+        tasks = [await self.scheduler.next_task(self.db)]
+        calls = tasks[0].CALLS
+        while calls < execute.MAX_CALLS:
+            task = self.scheduler.poll(execute.MAX_CALLS - calls)
+            if task is None:
+                break
+            tasks.append(task)
+            calls += task.CALLS
+        started = self.loop.time()
+        failed = True
+        try:
+            token = await self.token_pool.get(self.db)
+            started = self.loop.time()
             try:
-                await task.handle(session, token)
-            except (aiohttp.ClientError, errors.Error, asyncio.TimeoutError) as err:
+                results = await execute.send(session, token, tasks, self.parsing)
+            except (errors.VKAPIThrottlingError, errors.VKAPIAuthError) as err:
                 logging.warning(repr(err))
-                self._handle_failed_task(task)
+                await self.token_pool.failed(token, err, self.db)
+                await self._retry(tasks, penalize=False)
+                return
+            self.token_pool.succeeded(token)
+            failed = False
+        except psycopg2.Error as err:
+            # The database, not the tasks, has failed
+            logging.exception(err)
+            await self._retry(tasks, penalize=False)
+        except (aiohttp.ClientError, errors.Error, asyncio.TimeoutError) as err:
+            logging.warning(repr(err))
+            await self._retry(tasks)
+        except Exception as err:
+            logging.exception(err)
+            await self._retry(tasks)
+        else:
+            for task, (result, call_errors) in zip(tasks, results):
+                await self._handle_results(task, result, call_errors)
+        finally:
+            for task in tasks:
+                self.scheduler.done(task)
+            self.controller.observe(self.loop.time() - started, failed)
+
+    async def _retry(self, tasks, penalize=True):
+        # Every task is retried once, however the cancellations of the others fail
+        for task in tasks:
+            try:
+                await self.scheduler.retry(task, self.db, penalize=penalize)
             except Exception as err:
                 logging.exception(err)
-                self._handle_failed_task(task)
 
-    def _get_highest_priority_task(self):
-        taskcls = min(self.task_classes, key=lambda cls: cls.deadline())
-        return taskcls()
+    async def _handle_results(self, task, result, call_errors):
+        try:
+            await task.handle_results(result, call_errors, self.db)
+        except (errors.VKAPIThrottlingError, errors.VKAPIAuthError) as err:
+            logging.warning(repr(err))
+            await self.scheduler.retry(task, self.db, penalize=False)
+        except psycopg2.Error as err:
+            logging.exception(err)
+            await self.scheduler.retry(task, self.db, penalize=False)
+        except errors.Error as err:
+            logging.warning(repr(err))
+            await self.scheduler.retry(task, self.db)
+        except Exception as err:
+            logging.exception(err)
+            await self.scheduler.retry(task, self.db)
 
-    def _handle_failed_task(self, task):
-        task.tries += 1
-        if task.tries < TRIES_PER_TASK:
-            self.buffer.append(task)
-        else:
-            task.cancel()
+    async def _report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL, loop=self.loop)
+            logging.info('scheduler: depth=%s %s' % (self.scheduler.depth(), self.scheduler.stats()))
+            logging.info('workers: %s' % self.controller.stats())
+            logging.info('tokens: %s active, %s slot reservations' % (len(self.token_pool), self.token_pool.reservations))
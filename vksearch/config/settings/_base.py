@@ -133,3 +133,12 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# The search in the process memory (see vksearch/engine.py), needs numpy
+IN_MEMORY_SEARCH = False
+IN_MEMORY_SEARCH_REFRESH_INTERVAL = 60  # in seconds
+
+# The found pages are cached until "data_version" changes (see vksearch/cache.py)
+SEARCH_CACHE_MAX_SIZE = 16 * 1024 * 1024  # in bytes
+SEARCH_CACHE_VERSION_TTL = 5  # in seconds
@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+
+
+class DataVersion:
+    # "data_version" is advanced by vkapi whenever it changes what the search finds,
+    # it's read at most every SEARCH_CACHE_VERSION_TTL seconds
+
+    def __init__(self):
+        self._value = None
+        self._read = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # Returns (version, updated)
+        with self._lock:
+            now = time.monotonic()
+            if self._read is None or now - self._read >= settings.SEARCH_CACHE_VERSION_TTL:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT "version", "updated" FROM "data_version"')
+                    self._value = cursor.fetchone()
+                self._read = now
+            return self._value
+
+
+class SearchResult:
+    # A found page in arrays, so its size can be counted against the memory cap
+
+    OVERHEAD = 512  # bytes, the object, the arrays and the key
+
+    __slots__ = ('vkids', 'sums', 'percs', 'total', 'has_previous', 'has_next')
+
+    def __init__(self, found, total, has_previous, has_next):
+        self.vkids = array('i', (vkid for vkid, _, _ in found))
+        self.sums = array('q', (audience_sum for _, audience_sum, _ in found))
+        self.percs = array('i', (-1 if audience_perc is None else audience_perc for _, _, audience_perc in found))
+        self.total = total
+        self.has_previous = has_previous
+        self.has_next = has_next
+
+    def __iter__(self):
+        for vkid, audience_sum, audience_perc in zip(self.vkids, self.sums, self.percs):
+            yield vkid, audience_sum, None if audience_perc < 0 else audience_perc
+
+    def size(self):
+        return self.OVERHEAD + sum(len(a) * a.itemsize for a in (self.vkids, self.sums, self.percs))
+
+
+class SearchCache:
+    # LRU of the found pages by the normalized search,
+    # the pages of an older data version are dropped when they are hit
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] != version:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, result):
+        if result.size() > self.max_size:
+            return
+        with self._lock:
+            if key in self._results:
+                self._pop(key)
+            self._results[key] = (version, result)
+            self.size += result.size()
+            while self.size > self.max_size:
+                self._pop(next(iter(self._results)))
+
+    def _pop(self, key):
+        _, result = self._results.pop(key)
+        self.size -= result.size()
+
+
+def search_key(cleaned_data, *args):
+    # The same searches have the same key whatever the order of the chosen values
+    items = []
+    for name, value in sorted(cleaned_data.items()):
+        if isinstance(value, (list, tuple)):
+            value = tuple(sorted(int(getattr(v, 'pk', v)) for v in value))
+        items.append((name, value))
+    return tuple(items) + args
+
+
+def make_etag(*args):
+    return hashlib.md5(repr(args).encode('utf-8')).hexdigest()
+
+
+data_version = DataVersion()
+search_cache = SearchCache(settings.SEARCH_CACHE_MAX_SIZE)
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from datetime import timedelta as TimeDelta
+
+from django.conf import settings
+from django.db import connection
+
+from .models import AudienceCube, Profile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class AudienceMatrix:
+    # The communities x profiles counts as sparse (row, profile id, count) columns,
+    # a search is a masked sum per row and a top-k instead of an aggregate in Postgres.
+    # A refresh reloads only the communities updated since the previous one.
+
+    OVERLAP = 60  # seconds, the updates of long transactions become visible late
+
+    def __init__(self):
+        self.vkids = np.zeros(0, np.int32)
+        self.members = np.zeros(0, np.float64)  # NaN: unknown
+        self.active = np.zeros(0, bool)
+        self.rows = np.zeros(0, np.int32)
+        self.profiles = np.zeros(0, np.uint16)
+        self.counts = np.zeros(0, np.int64)
+        self.vkid2row = {}
+        self.updated = None
+        self.audience_updated = None
+
+    def refresh(self):
+        with connection.cursor() as cursor:
+            self._refresh_communities(cursor)
+            self._refresh_audiences(cursor)
+
+    def _refresh_communities(self, cursor):
+        sql = ('SELECT "vkid", "members", "deactivated", "updated" '
+               'FROM "community"')
+        if self.updated is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql + ' WHERE "updated" > %s', (self._since(self.updated),))
+        new_vkids, new_members, new_active = [], [], []
+        members, active = self.members.copy(), self.active.copy()
+        for vkid, num, deactivated, updated in cursor:
+            row = self.vkid2row.get(vkid)
+            num = float('nan') if num is None else num
+            if row is None:
+                self.vkid2row[vkid] = len(self.vkids) + len(new_vkids)
+                new_vkids.append(vkid)
+                new_members.append(num)
+                new_active.append(not deactivated)
+            else:
+                members[row] = num
+                active[row] = not deactivated
+            if self.updated is None or updated > self.updated:
+                self.updated = updated
+        self.vkids = np.concatenate((self.vkids, np.array(new_vkids, np.int32)))
+        self.members = np.concatenate((members, np.array(new_members, np.float64)))
+        self.active = np.concatenate((active, np.array(new_active, bool)))
+
+    def _refresh_audiences(self, cursor):
+        sql = ('SELECT c."vkid", c."audience_updated", a."profile_id", a."count" '
+               'FROM "community" AS c JOIN "audience" AS a ON a."community_vkid" = c."vkid"')
+        if self.audience_updated is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql + ' WHERE c."audience_updated" > %s', (self._since(self.audience_updated),))
+        rows, profiles, counts = [], [], []
+        for vkid, audience_updated, profile_id, count in cursor:
+            row = self.vkid2row.get(vkid)
+            if row is None:
+                # Inserted after the communities were refreshed
+                continue
+            rows.append(row)
+            profiles.append(profile_id)
+            counts.append(count)
+            if self.audience_updated is None or audience_updated > self.audience_updated:
+                self.audience_updated = audience_updated
+        rows = np.array(rows, np.int32)
+        # The reloaded audiences replace the old ones
+        keep = ~np.isin(self.rows, np.unique(rows))
+        self.rows = np.concatenate((self.rows[keep], rows))
+        self.profiles = np.concatenate((self.profiles[keep], np.array(profiles, np.uint16)))
+        self.counts = np.concatenate((self.counts[keep], np.array(counts, np.int64)))
+
+    def _since(self, timestamp):
+        return timestamp - TimeDelta(seconds=self.OVERLAP)
+
+    def search(self, ordering, inverted, limit,
+               min_members=None, max_members=None, min_audience=None, max_audience=None,
+               min_audience_perc=None, max_audience_perc=None, sex_ids=None, age_ranges=None,
+               countries=None, apps=None, after=None, before=None):
+        # Returns (vkid, audience sum, audience perc) of the found communities in the order of AudienceQuery
+        # (after the "after" cursor or before the "before" one) and the number of all of them
+        profile_mask = self._profile_mask(sex_ids, age_ranges, countries, apps)
+        weights = self.counts if profile_mask is None else self.counts * profile_mask[self.profiles]
+        sums = np.bincount(self.rows, weights=weights, minlength=len(self.vkids))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percs = np.where(self.members > 0, np.floor(100 * sums / self.members), np.nan)
+
+        found = self.active & (sums > 0)
+        for values, min_value, max_value in ((self.members, min_members, max_members),
+                                             (sums, min_audience, max_audience),
+                                             (percs, min_audience_perc, max_audience_perc)):
+            # NaN fails every comparison like NULL
+            if min_value is not None:
+                found &= values >= min_value
+            if max_value is not None:
+                found &= values <= max_value
+        found = np.flatnonzero(found)
+
+        total = len(found)
+
+        keys = {'members': self.members, 'audience_sum': sums, 'audience_perc': percs}[ordering][found]
+        # Like NULLs in Postgres, the unknown values are the greatest ones
+        keys = np.where(np.isnan(keys), np.inf, keys)
+        vkids = self.vkids[found].astype(np.int64)
+        if inverted:
+            keys, vkids = -keys, -vkids
+        # From here on the results are in the ascending order of (keys, vkids)
+        cursor = after or before
+        if cursor is not None:
+            key, vkid = cursor
+            key = np.inf if key is None else key
+            if inverted:
+                key, vkid = -key, -vkid
+            if after is not None:
+                chosen = (keys > key) | ((keys == key) & (vkids > vkid))
+            else:
+                chosen = (keys < key) | ((keys == key) & (vkids < vkid))
+                # The nearest ones to the cursor
+                keys, vkids = -keys, -vkids
+            found, keys, vkids = found[chosen], keys[chosen], vkids[chosen]
+        if len(found) > limit:
+            # The ties of the last key are kept for the order by vkid
+            last = np.partition(keys, limit - 1)[limit - 1]
+            top = keys <= last
+            found, keys, vkids = found[top], keys[top], vkids[top]
+        found = found[np.lexsort((vkids, keys))[:limit]]
+        if before is not None:
+            found = found[::-1]
+        return [(int(self.vkids[row]), int(sums[row]), None if np.isnan(percs[row]) else int(percs[row]))
+                for row in found], total
+
+    @staticmethod
+    def _profile_mask(sex_ids, age_ranges, countries, apps):
+        if not (sex_ids or age_ranges or countries or apps):
+            return None
+        pids = np.arange(Profile.SEXES_NUM * Profile.AGE_RANGES_NUM * Profile.COUNTRY_SLOTS * Profile.APPS_NUM)
+        # Must match Profile.decode()
+        pids, app_slots = np.divmod(pids, Profile.APPS_NUM)
+        pids, country_slots = np.divmod(pids, Profile.COUNTRY_SLOTS)
+        sexes, age_slots = np.divmod(pids, Profile.AGE_RANGES_NUM)
+        mask = np.ones(len(pids), bool)
+        for values, ids in ((sexes, sex_ids), (age_slots + 1, age_ranges),
+                            (country_slots - 1, countries), (app_slots + 1, apps)):
+            if ids:
+                mask &= np.isin(values, AudienceCube.objects.ids(ids))
+        return mask
+
+
+_matrix = None
+_refreshed = None
+_lock = threading.Lock()
+
+
+def available():
+    return getattr(settings, 'IN_MEMORY_SEARCH', False) and np is not None
+
+
+def search(ordering, inverted, limit, *args, **kwargs):
+    # Finds the communities in the process memory like AudienceQuery.find(),
+    # returns them and the number of all the found ones
+    global _matrix, _refreshed
+    with _lock:
+        if _matrix is None:
+            _matrix = AudienceMatrix()
+        if _refreshed is None or time.monotonic() - _refreshed >= settings.IN_MEMORY_SEARCH_REFRESH_INTERVAL:
+            started = time.monotonic()
+            _matrix.refresh()
+            _refreshed = time.monotonic()
+            logging.debug('the search matrix was refreshed in %.3fs' % (_refreshed - started))
+        return _matrix.search(ordering, inverted, limit, *args, **kwargs)
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import connection, models
 
 
 class CommunityType(models.Model):
@@ -33,35 +33,35 @@ class CommunityManager(models.Manager):
 
         audience_filter = {}
         if min_audience is not None:
-            audience_filter['audience__gte'] = min_audience
+            audience_filter['audience_sum__gte'] = min_audience
         if max_audience is not None:
-            audience_filter['audience__lte'] = max_audience
+            audience_filter['audience_sum__lte'] = max_audience
         if min_audience_perc is not None:
             audience_filter['audience_perc__gte'] = min_audience_perc
         if max_audience_perc is not None:
             audience_filter['audience_perc__lte'] = max_audience_perc
 
-        profile_filter = {}
-        if sex_ids:
-            profile_filter['audience__profile__sex_vkid__in'] = sex_ids
-        if age_ranges:
-            profile_filter['audience__profile__age_range__in'] = age_ranges
-        if countries:
-            profile_filter['audience__profile__country__in'] = countries
-        if apps:
-            profile_filter['audience__profile__app__in'] = apps
-
-        return self.filter(
+        communities = self.filter(
             deactivated=False,
-            **members_filter,
-            **profile_filter
+            cube__isnull=False,
+            **members_filter
         ).select_related(
             'type'
-        ).annotate(
-            audience_sum=models.Sum('audience__count'),
-            audience_perc=100 * models.F('audience_sum') / models.F('members')
-        ).filter(
-            audience_sum__isnull=False,
+        )
+        if sex_ids or age_ranges or countries or apps:
+            communities = communities.annotate(
+                audience_sum=AudienceCube.objects.audience_sum(sex_ids, age_ranges, countries, apps)
+            ).annotate(
+                audience_perc=100 * models.F('audience_sum') / models.F('members')
+            ).filter(
+                audience_sum__gt=0
+            )
+        else:
+            communities = communities.annotate(
+                audience_sum=models.F('cube__total'),
+                audience_perc=models.F('cube__perc')
+            )
+        return communities.filter(
             **audience_filter
         ).order_by(
             ordering
@@ -137,12 +137,31 @@ class Profile(models.Model):
         (SEX_FEMALE, 'Female'),
         (SEX_MALE, 'Male')
     )
+
+    # The id is computed from the dimensions, see profile_id() in schema.sql
+    SEXES_NUM = 3
+    AGE_RANGES_NUM = 12
+    COUNTRY_SLOTS = 256
+    APPS_NUM = 5
+
     id = models.IntegerField(primary_key=True)
     sex_vkid = models.SmallIntegerField(choices=SEX_CHOICES)
     age_range = models.ForeignKey(AgeRange, db_column='age_range_id')
     country = models.ForeignKey(Country, db_column='country_vkid')
     app = models.ForeignKey(Application, db_column='app_id')
 
+    @classmethod
+    def encode(cls, sex_vkid, age_range_id, country_vkid, app_id):
+        return (((sex_vkid * cls.AGE_RANGES_NUM + age_range_id - 1) * cls.COUNTRY_SLOTS + country_vkid + 1)
+                * cls.APPS_NUM + app_id - 1)
+
+    @classmethod
+    def decode(cls, profile_id):
+        profile_id, app_slot = divmod(profile_id, cls.APPS_NUM)
+        profile_id, country_slot = divmod(profile_id, cls.COUNTRY_SLOTS)
+        sex_vkid, age_slot = divmod(profile_id, cls.AGE_RANGES_NUM)
+        return sex_vkid, age_slot + 1, country_slot - 1, app_slot + 1
+
     class Meta:
         managed = False
         db_table = 'profile'
@@ -152,7 +171,88 @@ class Audience(models.Model):
     community = models.ForeignKey(Community, db_column='community_vkid')
     profile = models.ForeignKey(Profile, db_column='profile_id')
     count = models.IntegerField()
+    margin = models.IntegerField(blank=True, null=True)  # None when the count is exact
 
     class Meta:
         managed = False
         db_table = 'audience'
+
+
+class AudienceCubeManager(models.Manager):
+
+    def audience_sum(self, sex_ids, age_ranges, countries, apps):
+        # The audience of the profiles with the given dimensions (all of them when not given)
+        # of the community of the outer query
+        if not countries:
+            sql = ('SELECT sum(q."cells"[i]) FROM "audience_cube" AS q, unnest(%s::int4[]) AS i '
+                   'WHERE q."community_vkid" = "community"."vkid"')
+            params = (self.cells(sex_ids, age_ranges, apps),)
+        elif not (sex_ids or age_ranges or apps):
+            sql = ('SELECT sum(q."countries"[v + 2]) FROM "audience_cube" AS q, unnest(%s::int4[]) AS v '
+                   'WHERE q."community_vkid" = "community"."vkid"')
+            params = (self.ids(countries),)
+        else:
+            sql = ('SELECT sum(q."cells"[i]) FROM "audience_cube_country" AS q, unnest(%s::int4[]) AS i '
+                   'WHERE q."community_vkid" = "community"."vkid" AND q."country_vkid" = ANY(%s::int2[])')
+            params = (self.cells(sex_ids, age_ranges, apps), self.ids(countries))
+        return models.expressions.RawSQL(sql, params, output_field=models.IntegerField())
+
+    def cells(self, sex_ids, age_ranges, apps):
+        # Indexes of the "cells" arrays of the profiles with the given dimensions
+        return [AudienceCube.cell(sex_vkid, age_range_id, app_id)
+                for sex_vkid in self.ids(sex_ids, range(Profile.SEXES_NUM))
+                for age_range_id in self.ids(age_ranges, range(1, Profile.AGE_RANGES_NUM + 1))
+                for app_id in self.ids(apps, range(1, Profile.APPS_NUM + 1))]
+
+    @staticmethod
+    def ids(values, default=()):
+        # The form gives model instances or strings
+        if not values:
+            return list(default)
+        return [int(getattr(value, 'pk', value)) for value in values]
+
+
+class AudienceCube(models.Model):
+    # Filled by refresh_audience_cube() in schema.sql, the arrays are only used by raw SQL
+    community = models.OneToOneField(Community, primary_key=True, db_column='community_vkid', related_name='cube')
+    total = models.IntegerField()
+    perc = models.IntegerField(blank=True, null=True)
+
+    objects = AudienceCubeManager()
+
+    @staticmethod
+    def cell(sex_vkid, age_range_id, app_id):
+        # 1-based index in the "cells" arrays
+        return (sex_vkid * Profile.AGE_RANGES_NUM + age_range_id - 1) * Profile.APPS_NUM + app_id
+
+    class Meta:
+        managed = False
+        db_table = 'audience_cube'
+
+
+class SearchInterestManager(models.Manager):
+
+    def record(self, communities_ids):
+        # The collector crawls the audiences of the communities users see more often
+        if not communities_ids:
+            return
+        # The rows are locked in the same order by all the requests, or concurrent ones deadlock
+        sql = ('INSERT INTO "search_interest" AS i ("community_vkid", "hits") '
+               'SELECT v, 1 FROM unnest(%s::int4[]) AS v ORDER BY v '
+               'ON CONFLICT ("community_vkid") DO UPDATE '
+               'SET "hits" = search_interest_hits(i."hits", i."updated") + 1, '
+               '"updated" = CURRENT_TIMESTAMP')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, (sorted(set(communities_ids)),))
+
+
+class SearchInterest(models.Model):
+    community = models.OneToOneField(Community, primary_key=True, db_column='community_vkid')
+    hits = models.FloatField()
+    updated = models.DateTimeField()
+
+    objects = SearchInterestManager()
+
+    class Meta:
+        managed = False
+        db_table = 'search_interest'
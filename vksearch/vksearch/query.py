@@ -0,0 +1,212 @@
+import json
+
+from django.core import signing
+from django.db import connection
+
+from .models import AudienceCube, Community
+
+
+class AudienceQuery:
+    # Compiles the search into two queries. The first one finds the top communities
+    # in the narrow columns of "community" and "audience_cube" only: the dimensions of the profiles
+    # are resolved in advance into the indexes of the cube arrays, so neither "profile"
+    # nor "audience" is joined. The second one fetches the shown columns of just these communities.
+    # Pages are sought by (sort key, vkid) after or before a cursor instead of OFFSET.
+
+    COLUMNS = ('vkid', 'type__name', 'name', 'description', 'verified', 'age_limit', 'status', 'site', 'members')
+    # The raw columns, so the indexes on (key, vkid) serve the order and the seek of the unfiltered search.
+    # NULLs are the greatest keys like by default in ORDER BY, "audience_sum" is never NULL
+    ORDERINGS = {
+        'members': '"members"',
+        'audience_sum': '"audience_sum"',
+        'audience_perc': '"audience_perc"',
+    }
+    NULLABLE = ('members', 'audience_perc')
+
+    def __init__(self, ordering, inverted, limit,
+                 min_members=None, max_members=None, min_audience=None, max_audience=None,
+                 min_audience_perc=None, max_audience_perc=None, sex_ids=None, age_ranges=None,
+                 countries=None, apps=None, after=None, before=None):
+        self.ordering = ordering
+        self.inverted = inverted
+        self.limit = limit
+        self.ranges = (
+            ('"members"', min_members, max_members),
+            ('"audience_sum"', min_audience, max_audience),
+            ('"audience_perc"', min_audience_perc, max_audience_perc),
+        )
+        self.sex_ids = sex_ids
+        self.age_ranges = age_ranges
+        self.countries = countries
+        self.apps = apps
+        self.after = after  # (sort key, vkid)
+        self.before = before
+
+    def compile(self, seek=True):
+        # The first query, returns (sql, params)
+        source, params = self._source()
+        conditions = ['"audience_sum" > 0']
+        for column, min_value, max_value in self.ranges:
+            if min_value is not None:
+                conditions.append('%s >= %%s' % column)
+                params.append(min_value)
+            if max_value is not None:
+                conditions.append('%s <= %%s' % column)
+                params.append(max_value)
+        if not seek:
+            return self._filtered(source, conditions), params
+        descending = self.inverted
+        cursor = self.after or self.before
+        if self.before is not None:
+            # Sought backwards, execute() restores the order
+            descending = not descending
+        if cursor is not None:
+            conditions.append(self._seek(descending, cursor, params))
+        sql = ('{filtered} '
+               'ORDER BY {ordering} {direction} NULLS {nulls}, "vkid" {direction} '
+               'LIMIT %s').format(filtered=self._filtered(source, conditions),
+                                  ordering=self.ORDERINGS[self.ordering],
+                                  direction='DESC' if descending else 'ASC',
+                                  nulls='FIRST' if descending else 'LAST')
+        params.append(self.limit)
+        return sql, params
+
+    def _seek(self, descending, cursor, params):
+        # The rows after the cursor in the order, the NULL keys are compared by vkid only
+        column = self.ORDERINGS[self.ordering]
+        key, vkid = cursor
+        if key is None:
+            params.append(vkid)
+            if descending:
+                return '({0} IS NOT NULL OR "vkid" < %s)'.format(column)
+            return '({0} IS NULL AND "vkid" > %s)'.format(column)
+        params.extend((key, vkid))
+        if descending:
+            return '({0}, "vkid") < (%s, %s)'.format(column)
+        if self.ordering in self.NULLABLE:
+            return '(({0}, "vkid") > (%s, %s) OR {0} IS NULL)'.format(column)
+        return '({0}, "vkid") > (%s, %s)'.format(column)
+
+    def _filtered(self, source, conditions):
+        # "vkid" is taken from the table of the sort key, so (key, "vkid") is the key of its index
+        return ('SELECT "vkid", "members", "audience_sum", "audience_perc" FROM ('
+               'SELECT {vkid} AS "vkid", c."members", s."audience_sum", {perc} AS "audience_perc" '
+               'FROM "community" AS c JOIN ({source}) AS s ON s."community_vkid" = c."vkid" '
+               'WHERE c."deactivated" = FALSE'
+               ') AS f '
+               'WHERE {conditions}').format(vkid='c."vkid"' if self.ordering == 'members' else 's."community_vkid"',
+                                            perc=self._perc(), source=source, conditions=' AND '.join(conditions))
+
+    def _source(self):
+        # (community_vkid, audience_sum) of every community with an audience
+        if not (self.sex_ids or self.age_ranges or self.countries or self.apps):
+            sql = ('SELECT "community_vkid", "total" AS "audience_sum", "perc" '
+                   'FROM "audience_cube"')
+            return sql, []
+        cells = AudienceCube.objects.cells(self.sex_ids, self.age_ranges, self.apps)
+        if not self.countries:
+            sql = ('SELECT q."community_vkid", '
+                   '(SELECT sum(q."cells"[i]) FROM unnest(%s::int4[]) AS i) AS "audience_sum" '
+                   'FROM "audience_cube" AS q')
+            return sql, [cells]
+        countries = AudienceCube.objects.ids(self.countries)
+        if not (self.sex_ids or self.age_ranges or self.apps):
+            sql = ('SELECT q."community_vkid", '
+                   '(SELECT sum(q."countries"[v + 2]) FROM unnest(%s::int4[]) AS v) AS "audience_sum" '
+                   'FROM "audience_cube" AS q')
+            return sql, [countries]
+        sql = ('SELECT q."community_vkid", sum(q."cells"[i]) AS "audience_sum" '
+               'FROM "audience_cube_country" AS q, unnest(%s::int4[]) AS i '
+               'WHERE q."country_vkid" = ANY(%s::int2[]) '
+               'GROUP BY q."community_vkid"')
+        return sql, [cells, countries]
+
+    def _perc(self):
+        if not (self.sex_ids or self.age_ranges or self.countries or self.apps):
+            return 's."perc"'
+        return '100 * s."audience_sum" / NULLIF(c."members", 0)'
+
+    def find(self):
+        # Returns (vkid, audience sum, audience perc) of the found communities
+        sql, params = self.compile()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            found = [(vkid, audience_sum, audience_perc) for vkid, _, audience_sum, audience_perc in cursor]
+        if self.before is not None:
+            found.reverse()
+        return found
+
+    def execute(self):
+        # Returns the communities with "audience_sum" and "audience_perc" like CommunityManager.select()
+        return hydrate(self.find())
+
+    def estimate(self):
+        # The number of all the found communities according to the planner, counting them costs as much as the search
+        sql, params = self.compile(seek=False)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+
+def hydrate(found):
+    # The shown columns of the found (vkid, audience sum, audience perc)
+    vkid2comm = Community.objects.select_related('type').only(*AudienceQuery.COLUMNS).in_bulk(
+        [vkid for vkid, _, _ in found])
+    communities = []
+    for vkid, audience_sum, audience_perc in found:
+        comm = vkid2comm[vkid]
+        comm.audience_sum = audience_sum
+        comm.audience_perc = audience_perc
+        communities.append(comm)
+    return communities
+
+
+CURSOR_SALT = 'vksearch.query.cursor'
+
+
+def make_cursor(comm, ordering):
+    key = getattr(comm, ordering)
+    return signing.dumps((ordering, key, comm.vkid), salt=CURSOR_SALT)
+
+
+def parse_cursor(value, ordering):
+    # Returns (sort key or None, vkid), raises ValueError when the cursor is broken or of another ordering
+    try:
+        cursor_ordering, key, vkid = signing.loads(value, salt=CURSOR_SALT)
+    except (signing.BadSignature, TypeError) as err:
+        raise ValueError(err)
+    if cursor_ordering != ordering:
+        raise ValueError('The cursor is of another ordering')
+    # Integers like the columns, a float8 parameter would keep the indexes from serving the seek
+    return None if key is None else int(key), int(vkid)
+
+
+class Page:
+    # A page of the communities found by AudienceQuery or the engine
+
+    def __init__(self, communities, ordering, number, total, has_previous, has_next):
+        self.communities = communities
+        self.number = number
+        self.total = total
+        self.has_previous = has_previous
+        self.has_next = has_next
+        if communities:
+            self.previous_cursor = make_cursor(communities[0], ordering)
+            self.next_cursor = make_cursor(communities[-1], ordering)
+        else:
+            self.previous_cursor = self.next_cursor = None
+
+    def __iter__(self):
+        return iter(self.communities)
+
+    def __len__(self):
+        return len(self.communities)
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_number(self):
+        return self.number + 1
@@ -0,0 +1,41 @@
+from django.test import SimpleTestCase
+
+from ..cache import SearchCache, SearchResult, search_key
+
+
+class TestSearchCache(SimpleTestCase):
+
+    def _result(self, num):
+        return SearchResult([(vkid, vkid * 10, None if vkid % 2 else 50) for vkid in range(num)], num, False, False)
+
+    def test_result(self):
+        result = self._result(3)
+        self.assertEqual(list(result), [(0, 0, 50), (1, 10, None), (2, 20, 50)])
+
+    def test_versions(self):
+        cache = SearchCache(1024 * 1024)
+        cache.put('a', 1, self._result(3))
+        self.assertEqual(list(cache.get('a', 1)), list(self._result(3)))
+        self.assertIsNone(cache.get('a', 2))
+        self.assertIsNone(cache.get('a', 1))
+        self.assertEqual(cache.size, 0)
+
+    def test_eviction(self):
+        size = self._result(50).size()
+        cache = SearchCache(3 * size)
+        for key in 'abc':
+            cache.put(key, 1, self._result(50))
+        cache.get('a', 1)
+        cache.put('d', 1, self._result(50))
+        self.assertIsNone(cache.get('b', 1))
+        for key in 'acd':
+            self.assertIsNotNone(cache.get(key, 1))
+        self.assertLessEqual(cache.size, cache.max_size)
+
+        cache.put('e', 1, self._result(1000))
+        self.assertIsNone(cache.get('e', 1))
+
+    def test_key(self):
+        self.assertEqual(search_key({'sex': ['2', '1'], 'ordering': 'members'}, None),
+                         search_key({'ordering': 'members', 'sex': ('1', '2')}, None))
+        self.assertNotEqual(search_key({'sex': ['1']}, None), search_key({'sex': ['1']}, (1.0, 1)))
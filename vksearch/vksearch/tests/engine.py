@@ -0,0 +1,84 @@
+from os.path import join
+from unittest import skipIf
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+
+from .. import engine
+from ..models import Community
+
+
+@skipIf(engine.np is None, 'numpy is not installed')
+class TestAudienceMatrix(TestCase):
+
+    COMMUNITIES_NUM = 200
+
+    def setUp(self):
+        super().setUp()
+
+        communities_ids = range(self.COMMUNITIES_NUM)
+
+        with open(join(settings.BASE_DIR, '..', 'schema.sql'), encoding='utf-8') as fd:
+            sql = fd.read()
+        connection.cursor().execute(sql)
+
+        sql = r'INSERT INTO "community" ("vkid","deactivated","type","name","description","status","site","members") VALUES'
+        sql += ','.join(
+            "({0:d},FALSE,1,'NAME_{0:d}','DESCRIPTION_{0:d}','STATUS_{0:d}','SITE_{0:d}',{1:d})".format(cid, cid*2000+1)
+            for cid in communities_ids
+        )
+        sql += ';'
+        connection.cursor().execute(sql)
+
+        sql = r'INSERT INTO "audience" ("profile_id","community_vkid","count") VALUES'
+        sql += ','.join("(profile_id(1,1,1,1),{0:d},{1:d}),(profile_id(2,1,1,1),{0:d},{2:d})".format(
+            cid, cid*1000+1, cid+1) for cid in communities_ids)
+        sql += ';'
+        connection.cursor().execute(sql)
+
+        connection.cursor().execute('SELECT refresh_audience_cube("vkid") FROM "community"')
+
+        self.matrix = engine.AudienceMatrix()
+        self.matrix.refresh()
+
+    def test_search(self):
+        for filters in ({}, {'sex_ids': ['2']}, {'countries': [1], 'apps': [1]},
+                        {'min_audience': 1000, 'max_members': 100000}):
+            for ordering in ('members', 'audience_sum'):
+                expected = [(comm.vkid, comm.audience_sum, comm.audience_perc)
+                            for comm in Community.objects.select(ordering, True, **filters)[:50]]
+                found, total = self.matrix.search(ordering, True, 50, **filters)
+                self.assertEqual(found, expected)
+                self.assertEqual(total, Community.objects.select(ordering, True, **filters).count())
+            # The percentages have ties
+            expected = [(comm.vkid, comm.audience_sum, comm.audience_perc)
+                        for comm in Community.objects.select('audience_perc', False, **filters)]
+            found, _ = self.matrix.search('audience_perc', False, self.COMMUNITIES_NUM, **filters)
+            self.assertEqual(sorted(found), sorted(expected))
+            self.assertEqual([perc for _, _, perc in found], [perc for _, _, perc in expected])
+
+    def test_refresh(self):
+        sql = 'UPDATE "audience" SET "count" = 1 WHERE "community_vkid" = 0'
+        connection.cursor().execute(sql)
+        sql = 'UPDATE "community" SET "audience_updated" = CURRENT_TIMESTAMP + INTERVAL \'1 hour\' WHERE "vkid" = 0'
+        connection.cursor().execute(sql)
+        self.matrix.refresh()
+        found, _ = self.matrix.search('audience_sum', False, 1)
+        self.assertEqual(found, [(0, 2, 200)])
+
+    def test_seek(self):
+        # The percentages have ties, they are ordered by vkid
+        expected, _ = self.matrix.search('audience_perc', True, self.COMMUNITIES_NUM)
+        found, after = [], None
+        while True:
+            page, _ = self.matrix.search('audience_perc', True, 30, after=after)
+            if not page:
+                break
+            found.extend(page)
+            after = (page[-1][2], page[-1][0])
+        self.assertEqual(found, expected)
+
+        vkid, _, perc = expected[40]
+        page, _ = self.matrix.search('audience_perc', True, 30, before=(perc, vkid))
+        self.assertEqual(page, expected[10:40])
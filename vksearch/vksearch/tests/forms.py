@@ -33,12 +33,8 @@ class TestCommunitiesFilterForm(TestCase):
         sql += ';'
         connection.cursor().execute(sql)
 
-        sql = (r'INSERT INTO "profile" ("id","sex_vkid","age_range_id","country_vkid","app_id") '
-               r'VALUES (1,1,1,1,1)')
-        connection.cursor().execute(sql)
-
         sql = r'INSERT INTO "audience" ("profile_id","community_vkid","count") VALUES'
-        sql += ','.join("(1,{0:d},{1:d})".format(cid, cid * 1000 + 1) for cid in communities_ids)
+        sql += ','.join("(profile_id(1,1,1,1),{0:d},{1:d})".format(cid, cid * 1000 + 1) for cid in communities_ids)
         sql += ';'
         connection.cursor().execute(sql)
 
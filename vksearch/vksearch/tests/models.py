@@ -5,7 +5,7 @@ from django.conf import settings
 from django.db import connection
 from django.test import TestCase
 
-from ..models import Community
+from ..models import Community, Country, Profile, SearchInterest
 
 
 User = get_user_model()
@@ -32,15 +32,13 @@ class TestCommunity(TestCase):
         sql += ';'
         connection.cursor().execute(sql)
 
-        sql = (r'INSERT INTO "profile" ("id","sex_vkid","age_range_id","country_vkid","app_id") '
-               r'VALUES (1,1,1,1,1)')
-        connection.cursor().execute(sql)
-
         sql = r'INSERT INTO "audience" ("profile_id","community_vkid","count") VALUES'
-        sql += ','.join("(1,{0:d},{1:d})".format(cid, cid*1000+1) for cid in communities_ids)
+        sql += ','.join("(profile_id(1,1,1,1),{0:d},{1:d})".format(cid, cid*1000+1) for cid in communities_ids)
         sql += ';'
         connection.cursor().execute(sql)
 
+        connection.cursor().execute('SELECT refresh_audience_cube("vkid") FROM "community"')
+
     def test_select(self):
         communities = Community.objects.select('members', True)[:]
         self.assertEqual(len(communities), self.COMMUNITIES_NUM)
@@ -49,3 +47,65 @@ class TestCommunity(TestCase):
         communities = Community.objects.select('audience_sum', True, sex_ids=[1], age_ranges=[1], countries=[1], apps=[1])[:]
         self.assertEqual(len(communities), self.COMMUNITIES_NUM)
         self.assertEqual(communities[0].vkid, self.COMMUNITIES_NUM - 1)
+
+    def test_select_from_cube(self):
+        communities = Community.objects.select('audience_perc', False)[:]
+        self.assertEqual(len(communities), self.COMMUNITIES_NUM)
+        self.assertTrue(all(comm.audience_perc == 100 for comm in communities))
+
+        communities = Community.objects.select('audience_sum', True, sex_ids=['1'], apps=[1])[:]
+        self.assertEqual(len(communities), self.COMMUNITIES_NUM)
+        self.assertEqual(communities[0].audience_sum, (self.COMMUNITIES_NUM - 1) * 1000 + 1)
+
+        communities = Community.objects.select('audience_sum', True, countries=[1])[:]
+        self.assertEqual(len(communities), self.COMMUNITIES_NUM)
+
+        communities = Community.objects.select('audience_sum', True, sex_ids=[2], countries=[1])[:]
+        self.assertEqual(len(communities), 0)
+
+        communities = Community.objects.select('members', True, min_audience=1000, max_audience=2000)[:]
+        self.assertEqual([comm.vkid for comm in communities], [1])
+
+
+class TestSearchInterest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open(join(settings.BASE_DIR, '..', 'schema.sql'), encoding='utf-8') as fd:
+            sql = fd.read()
+        connection.cursor().execute(sql)
+        sql = (r'INSERT INTO "community" ("vkid","deactivated","type","name","description","status","site") '
+               r"VALUES (1,FALSE,1,'','','',''),(2,FALSE,1,'','','','')")
+        connection.cursor().execute(sql)
+
+    def test_record(self):
+        SearchInterest.objects.record([1, 2])
+        SearchInterest.objects.record([2])
+        SearchInterest.objects.record([])
+        hits = dict(SearchInterest.objects.values_list('community_id', 'hits'))
+        self.assertAlmostEqual(hits[1], 1, places=3)
+        self.assertAlmostEqual(hits[2], 2, places=3)
+
+        # The hits halve in a week until the next one
+        sql = 'UPDATE "search_interest" SET "updated" = "updated" - INTERVAL \'7 days\' WHERE "community_vkid" = 2'
+        connection.cursor().execute(sql)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT search_interest_hits("hits", "updated") FROM "search_interest" '
+                           'WHERE "community_vkid" = 2')
+            self.assertAlmostEqual(cursor.fetchone()[0], 1, places=3)
+
+
+class TestProfile(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open(join(settings.BASE_DIR, '..', 'schema.sql'), encoding='utf-8') as fd:
+            sql = fd.read()
+        connection.cursor().execute(sql)
+
+    def test_encode(self):
+        profiles = Profile.objects.all()
+        self.assertEqual(len(profiles), 3 * 12 * 5 * Country.objects.count())
+        for p in profiles:
+            self.assertEqual(Profile.encode(p.sex_vkid, p.age_range_id, p.country_id, p.app_id), p.id)
+            self.assertEqual(Profile.decode(p.id), (p.sex_vkid, p.age_range_id, p.country_id, p.app_id))
@@ -0,0 +1,136 @@
+import json
+from os.path import join
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+
+from ..models import Community
+from ..query import AudienceQuery, make_cursor, parse_cursor
+
+
+class TestAudienceQuery(TestCase):
+
+    COMMUNITIES_NUM = 200
+
+    def setUp(self):
+        super().setUp()
+
+        communities_ids = range(self.COMMUNITIES_NUM)
+
+        with open(join(settings.BASE_DIR, '..', 'schema.sql'), encoding='utf-8') as fd:
+            sql = fd.read()
+        connection.cursor().execute(sql)
+
+        sql = r'INSERT INTO "community" ("vkid","deactivated","type","name","description","status","site","members") VALUES'
+        sql += ','.join(
+            "({0:d},FALSE,1,'NAME_{0:d}','DESCRIPTION_{0:d}','STATUS_{0:d}','SITE_{0:d}',{1:d})".format(cid, cid*1000+1)
+            for cid in communities_ids
+        )
+        sql += ';'
+        connection.cursor().execute(sql)
+
+        sql = r'INSERT INTO "audience" ("profile_id","community_vkid","count") VALUES'
+        sql += ','.join("(profile_id(1,1,1,1),{0:d},{1:d})".format(cid, cid*1000+1) for cid in communities_ids)
+        sql += ';'
+        connection.cursor().execute(sql)
+
+        connection.cursor().execute('SELECT refresh_audience_cube("vkid") FROM "community"')
+
+    def _plan(self, query):
+        sql, params = query.compile()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (VERBOSE, FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def _nodes(self, node):
+        yield node
+        for child in node.get('Plans', ()):
+            yield from self._nodes(child)
+
+    def test_plan(self):
+        for filters in ({}, {'sex_ids': ['1']}, {'countries': [1]}, {'sex_ids': ['1'], 'countries': [1], 'apps': [1]}):
+            plan = self._plan(AudienceQuery('audience_sum', True, 50, min_members=1, **filters))
+            # Top-k instead of sorting everything
+            self.assertEqual(plan['Node Type'], 'Limit')
+            nodes = list(self._nodes(plan))
+            relations = {node['Relation Name'] for node in nodes if 'Relation Name' in node}
+            self.assertNotIn('profile', relations)
+            self.assertNotIn('audience', relations)
+            self.assertIn('community', relations)
+            # The wide columns are fetched only for the found communities
+            for node in nodes:
+                self.assertFalse(any('description' in output for output in node.get('Output', ())))
+
+    def test_plan_index(self):
+        # The unfiltered pages are read in the order of the indexes on (key, vkid), however many are found
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_sort = off')
+        for ordering in ('members', 'audience_sum', 'audience_perc'):
+            for inverted in (True, False):
+                for cursor in (None, (1000, 10)):
+                    plan = self._plan(AudienceQuery(ordering, inverted, 50, after=cursor))
+                    self.assertEqual(plan['Node Type'], 'Limit')
+                    nodes = list(self._nodes(plan))
+                    self.assertNotIn('Sort', [node['Node Type'] for node in nodes])
+                    scans = [node for node in nodes if node['Node Type'] in ('Index Scan', 'Index Only Scan')]
+                    self.assertTrue(scans)
+                    if cursor is not None and (inverted or ordering == 'audience_sum'):
+                        # The cursor is sought in the index, unless the NULLs after it are OR-ed in
+                        self.assertTrue(any('vkid' in node.get('Index Cond', '') for node in scans))
+
+    def test_execute(self):
+        for filters in ({}, {'sex_ids': ['1'], 'age_ranges': [1]}, {'countries': [1]},
+                        {'countries': [1], 'apps': [1], 'min_audience': 1000}):
+            expected = [(comm.vkid, comm.audience_sum, comm.audience_perc)
+                        for comm in Community.objects.select('members', True, **filters)[:50]]
+            found = [(comm.vkid, comm.audience_sum, comm.audience_perc)
+                     for comm in AudienceQuery('members', True, 50, **filters).execute()]
+            self.assertEqual(found, expected)
+
+        communities = AudienceQuery('audience_sum', False, 10, sex_ids=['2']).execute()
+        self.assertEqual(communities, [])
+
+    def test_seek(self):
+        expected = [comm.vkid for comm in Community.objects.select('audience_sum', True)]
+        found, after = [], None
+        while True:
+            page = AudienceQuery('audience_sum', True, 30, after=after).execute()
+            if not page:
+                break
+            found.extend(comm.vkid for comm in page)
+            after = parse_cursor(make_cursor(page[-1], 'audience_sum'), 'audience_sum')
+        self.assertEqual(found, expected)
+
+        before = parse_cursor(make_cursor(Community.objects.get(vkid=expected[40]), 'members'), 'members')
+        page = AudienceQuery('members', True, 30, before=before).execute()
+        self.assertEqual([comm.vkid for comm in page], expected[10:40])
+
+        with self.assertRaises(ValueError):
+            parse_cursor(make_cursor(page[0], 'members'), 'audience_sum')
+
+    def test_seek_nulls(self):
+        connection.cursor().execute('UPDATE "community" SET "members" = NULL WHERE "vkid" % 3 = 0')
+        for inverted in (True, False):
+            # The NULLs are ties, they are ordered by vkid
+            order = ('-members', '-vkid') if inverted else ('members', 'vkid')
+            expected = [comm.vkid for comm in Community.objects.select('members', inverted).order_by(*order)]
+            found, after = [], None
+            while True:
+                page = AudienceQuery('members', inverted, 30, after=after).execute()
+                if not page:
+                    break
+                found.extend(comm.vkid for comm in page)
+                after = parse_cursor(make_cursor(page[-1], 'members'), 'members')
+            self.assertEqual(found, expected)
+
+            for i in (10, 100, 150):
+                before = parse_cursor(make_cursor(Community.objects.get(vkid=expected[i]), 'members'), 'members')
+                page = AudienceQuery('members', inverted, 5, before=before).execute()
+                self.assertEqual([comm.vkid for comm in page], expected[i - 5:i])
+
+    def test_estimate(self):
+        self.assertGreater(AudienceQuery('members', True, 50).estimate(), 0)
@@ -1,15 +1,20 @@
+from calendar import timegm
+
 from django.shortcuts import render, Http404
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_GET
 from django.views.decorators.csrf import csrf_exempt
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
-from .models import Community
+from . import engine
+from .cache import SearchResult, data_version, make_etag, search_cache, search_key
+from .models import SearchInterest
+from .query import AudienceQuery, Page, hydrate, parse_cursor
 from .forms import CommunitiesFilterForm
 
 
 COMMUNITIES_PER_PAGE = 50
-COMMUNITIES_LIMIT = 5 * COMMUNITIES_PER_PAGE
 
 
 @csrf_exempt
@@ -17,24 +22,70 @@ COMMUNITIES_LIMIT = 5 * COMMUNITIES_PER_PAGE
 @login_required(login_url='/user/login', redirect_field_name=None)
 def communities_view(req):
     form = CommunitiesFilterForm(req.GET)
-    if form.is_valid():
-        communities = Community.objects.select(
-            form.cleaned_data['ordering'], form.cleaned_data["inverted"],
-            form.cleaned_data['min_members'], form.cleaned_data['max_members'],
-            form.cleaned_data['min_audience'], form.cleaned_data['max_audience'],
-            form.cleaned_data['min_audience_perc'], form.cleaned_data['max_audience_perc'],
-            form.cleaned_data['sex'], form.cleaned_data['age_ranges'],
-            form.cleaned_data['countries'], form.cleaned_data['apps']
-        )[:COMMUNITIES_LIMIT]
-        paginator = Paginator(communities, COMMUNITIES_PER_PAGE)
-        page_num = req.GET.get('page', 1)
-        try:
-            communities = paginator.page(page_num)
-        except (PageNotAnInteger, EmptyPage):
-            raise Http404()
+    if not form.is_valid():
+        return render(req, 'communities.html', {
+            'communities': [],
+            'form': form
+        })
+
+    ordering, inverted = form.cleaned_data['ordering'], form.cleaned_data["inverted"]
+    try:
+        page_num = int(req.GET.get('page', 1))
+        after = _parse_cursor(req.GET.get('after'), ordering)
+        before = _parse_cursor(req.GET.get('before'), ordering)
+    except ValueError:
+        raise Http404()
+
+    key = search_key(form.cleaned_data, after, before)
+    version, updated = data_version.get()
+    # The page also shows the user and the CSRF token
+    etag = quote_etag(make_etag(version, key, page_num, req.user.pk, req.META.get('CSRF_COOKIE')))
+    last_modified = timegm(updated.utctimetuple())
+    response = get_conditional_response(req, etag=etag, last_modified=last_modified)
+    if response is None:
+        result = search_cache.get(key, version)
+        if result is None:
+            result = _search(form, after, before)
+            search_cache.put(key, version, result)
+        communities = Page(hydrate(result), ordering, page_num, result.total, result.has_previous, result.has_next)
+        SearchInterest.objects.record([comm.vkid for comm in communities])
+        response = render(req, 'communities.html', {
+            'communities': communities,
+            'form': form
+        })
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Browsers have to revalidate the page, it's free when nothing has changed
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _search(form, after, before):
+    ordering, inverted = form.cleaned_data['ordering'], form.cleaned_data["inverted"]
+    filters = (
+        form.cleaned_data['min_members'], form.cleaned_data['max_members'],
+        form.cleaned_data['min_audience'], form.cleaned_data['max_audience'],
+        form.cleaned_data['min_audience_perc'], form.cleaned_data['max_audience_perc'],
+        form.cleaned_data['sex'], form.cleaned_data['age_ranges'],
+        form.cleaned_data['countries'], form.cleaned_data['apps']
+    )
+    # One more community tells whether there is one more page
+    if engine.available():
+        found, total = engine.search(ordering, inverted, COMMUNITIES_PER_PAGE + 1, *filters,
+                                     after=after, before=before)
+    else:
+        query = AudienceQuery(ordering, inverted, COMMUNITIES_PER_PAGE + 1, *filters, after=after, before=before)
+        found, total = query.find(), query.estimate()
+    if before is None:
+        has_previous, has_next = after is not None, len(found) > COMMUNITIES_PER_PAGE
+        found = found[:COMMUNITIES_PER_PAGE]
     else:
-        communities = []
-    return render(req, 'communities.html', {
-        'communities': communities,
-        'form': form
-    })
+        has_previous, has_next = len(found) > COMMUNITIES_PER_PAGE, True
+        found = found[-COMMUNITIES_PER_PAGE:]
+    return SearchResult(found, total, has_previous, has_next)
+
+
+def _parse_cursor(value, ordering):
+    if not value:
+        return None
+    return parse_cursor(value, ordering)